@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+#
+# Cold-start benchmark for the SecurityHub Enabler Lambda handlers.
+# Every run imports one handler module in a fresh interpreter (as a new
+# Lambda container would), then builds its first AWS client, and reports:
+#   import_ms - module import and module-level init (Lambda INIT phase)
+#   client_ms - first boto3 client construction (paid by the first request)
+#
+# Usage:
+#   python3 bench/cold_start.py [--runs 10] [--max-import-ms 500] [--json]
+# Exits with 1 when the p50 import time of a handler exceeds --max-import-ms.
+#
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SRC_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+HANDLERS = [
+    'sh_sm_launcher',
+    'sh_member_enabler',
+    'sh_admin_enabler',
+    'sh_member_invite',
+    'sh_account_pipeline',
+    'sh_enabler_event'
+]
+
+PROBE = '''
+import json, time
+started = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+assert callable({module}.lambda_handler)
+import boto3
+from sh_clients import get_client
+get_client(boto3.Session(), 'securityhub', 'us-east-1')
+client_built = time.perf_counter()
+print(json.dumps({{
+    'import_ms': (imported - started) * 1000,
+    'client_ms': (client_built - imported) * 1000
+}}))
+'''
+
+def probe_env():
+    # no credentials lookup or network access during the benchmark
+    env = dict(os.environ)
+    env.update({
+        'AWS_ACCESS_KEY_ID': 'testing',
+        'AWS_SECRET_ACCESS_KEY': 'testing',
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'AWS_EC2_METADATA_DISABLED': 'true',
+        'PYTHONDONTWRITEBYTECODE': '1'
+    })
+    return env
+
+def run_probe(module):
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE.format(module=module)],
+        cwd=SRC_DIRECTORY,
+        env=probe_env(),
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True
+    ).stdout
+    # handlers may print at import, the timings are on the last line
+    return json.loads(output.strip().splitlines()[-1])
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def summarize(samples):
+    return {
+        'p50': statistics.median(samples),
+        'p90': percentile(samples, 0.9),
+        'max': max(samples)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold-start benchmark for the SecurityHub Enabler handlers')
+    parser.add_argument('--runs', type=int, default=10, help='fresh interpreters per handler')
+    parser.add_argument('--max-import-ms', type=float, default=None, help='fail when p50 import time exceeds this')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    report = {}
+    for module in HANDLERS:
+        samples = [run_probe(module) for i in range(args.runs)]
+        report[module] = {
+            'import_ms': summarize([sample['import_ms'] for sample in samples]),
+            'client_ms': summarize([sample['client_ms'] for sample in samples])
+        }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print('{:<22} {:>12} {:>12} {:>12} {:>12}'.format('handler', 'import p50', 'import p90', 'client p50', 'client p90'))
+        for module, timings in report.items():
+            print('{:<22} {:>10.1f}ms {:>10.1f}ms {:>10.1f}ms {:>10.1f}ms'.format(
+                module,
+                timings['import_ms']['p50'], timings['import_ms']['p90'],
+                timings['client_ms']['p50'], timings['client_ms']['p90']
+            ))
+
+    if args.max_import_ms is not None:
+        slow = [module for module, timings in report.items() if timings['import_ms']['p50'] > args.max_import_ms]
+        if len(slow) > 0:
+            print('Import time regression (p50 > {} ms): {}'.format(args.max_import_ms, ', '.join(slow)))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
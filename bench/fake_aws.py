@@ -0,0 +1,532 @@
+#
+# In-process AWS stand-in for the SecurityHub Enabler benchmarks.
+# It answers every call made through sh_clients.get_client from a small
+# in-memory model of STS, Organizations, CloudFormation, Step Functions,
+# EventBridge and SecurityHub, with injectable per-call latency and
+# throttling, and counts calls per (service, operation).
+#
+# Calls are answered from botocore's before-call event, so nothing leaves
+# the process; the client side (parameter validation, paginators, modeled
+# exceptions) is the real botocore code.
+#
+
+import re
+import threading
+import time
+import random
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+import sh_clients
+
+MANAGEMENT_ACCOUNT = '111111111111'
+
+STANDARDS = [
+    'arn:aws:securityhub:{region}::standards/aws-foundational-security-best-practices/v/1.0.0',
+    'arn:aws:securityhub:::ruleset/cis-aws-foundations-benchmark/v/1.2.0'
+]
+
+THROTTLE_ERRORS = {
+    'securityhub': 'TooManyRequestsException',
+    'organizations': 'TooManyRequestsException'
+}
+
+class FakeHttpResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+        self.content = b''
+
+class FakeError(Exception):
+    def __init__(self, code, message='', status_code=400):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.status_code = status_code
+
+def snake_case(name):
+    return re.sub(r'(?<!^)(?=[A-Z])', '_', name).lower()
+
+class FakeAws:
+    def __init__(self, latency_ms=0, jitter_ms=0, throttle_rate=0.0, max_attempts=5,
+            invite_delay_ms=0, latencies=None, rate_limits=None, event_failure_rate=0.0, seed=None):
+        # latencies: { 'service.Operation': ms } overrides latency_ms
+        # rate_limits: { 'service.Operation' or 'service.*': (rate, burst) } enforced
+        # per (caller, region, operation), calls over the limit are throttled
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.throttle_rate = throttle_rate
+        self.rate_limits = rate_limits or {}
+        self.rate_buckets = {}
+        self.max_attempts = max_attempts
+        self.invite_delay_ms = invite_delay_ms
+        # probability that a PutEvents entry fails on its own (FailedEntryCount)
+        self.event_failure_rate = event_failure_rate
+        self.latencies = latencies or {}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.throttles = Counter()
+        # Organizations
+        self.accounts = {}
+        self.parents = {}
+        # Control Tower governed regions
+        self.ct_regions = []
+        # Step Functions / EventBridge
+        self.state_machines = {}
+        self.executions = []
+        self.events = []
+        # DynamoDB, keyed by (table, pk)
+        self.items = {}
+        # SecurityHub, keyed by (account, region)
+        self.hubs = {}
+        self.invitations = {}
+        # SecurityHub organization mode: region -> delegated administrator,
+        # (administrator, region) -> organization configuration
+        self.organization_admins = {}
+        self.organization_configs = {}
+
+    # model setup
+
+    def add_account(self, account_id, email, parent_id):
+        self.accounts[account_id] = { 'email': email, 'parent': parent_id }
+        # accounts joining the organization are enrolled where auto-enable is on
+        for (administrator, region), configuration in self.organization_configs.items():
+            if configuration['AutoEnable']:
+                self.enroll_organization_account(administrator, region, account_id)
+
+    def add_organizational_unit(self, ou_id, parent_id):
+        self.parents[ou_id] = parent_id
+
+    def add_state_machine(self, name):
+        arn = 'arn:aws:states:us-east-1:{}:stateMachine:{}'.format(MANAGEMENT_ACCOUNT, name)
+        self.state_machines[name] = arn
+        return arn
+
+    def install(self):
+        sh_clients.register_client_hook(self.attach)
+
+    def attach(self, client, session):
+        client.meta.events.register('before-parameter-build', self.capture_params)
+        client.meta.events.register('before-call', self.handle_call)
+
+    # botocore event handlers
+
+    def capture_params(self, params, context, **kwargs):
+        context['fake_aws_params'] = dict(params)
+
+    def handle_call(self, model, request_signer, context, **kwargs):
+        service = model.service_model.service_name
+        operation = model.name
+        params = context.get('fake_aws_params', {})
+        caller = self.get_caller(request_signer)
+        region = request_signer._region_name
+        attempts = 0
+        while True:
+            attempts += 1
+            self.sleep_latency(service, operation)
+            with self.lock:
+                self.calls[(service, operation)] += 1
+                throttled = (self.throttle_rate > 0 and self.random.random() < self.throttle_rate) or \
+                    self.over_rate_limit(caller, region, service, operation)
+                if throttled:
+                    self.throttles[(service, operation)] += 1
+            if not throttled:
+                break
+            if attempts >= self.max_attempts:
+                return self.error_response(FakeError(THROTTLE_ERRORS.get(service, 'ThrottlingException'), 'Rate exceeded'))
+            # client side backoff, as botocore's retry handler would do
+            time.sleep(min(0.05 * (2 ** attempts), 1.0) * self.random.random())
+        handler = getattr(self, '{}_{}'.format(service.replace('-', '_'), snake_case(operation)), None)
+        if handler is None:
+            return self.error_response(FakeError('NotImplemented', '{}.{} is not modeled'.format(service, operation)))
+        try:
+            with self.lock:
+                result = handler(caller, region, params)
+        except FakeError as e:
+            return self.error_response(e)
+        result.setdefault('ResponseMetadata', { 'HTTPStatusCode': 200, 'RequestId': uuid.uuid4().hex })
+        return FakeHttpResponse(200), result
+
+    def error_response(self, error):
+        return FakeHttpResponse(error.status_code), {
+            'Error': { 'Code': error.code, 'Message': error.message },
+            'ResponseMetadata': { 'HTTPStatusCode': error.status_code }
+        }
+
+    def over_rate_limit(self, caller, region, service, operation):
+        # token bucket per (caller, region, operation), called under the lock
+        limit = self.rate_limits.get('{}.{}'.format(service, operation), self.rate_limits.get('{}.*'.format(service)))
+        if limit is None:
+            return False
+        rate, burst = limit
+        now = time.monotonic()
+        tokens, updated = self.rate_buckets.get((caller, region, operation), (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        if tokens < 1:
+            self.rate_buckets[(caller, region, operation)] = (tokens, now)
+            return True
+        self.rate_buckets[(caller, region, operation)] = (tokens - 1, now)
+        return False
+
+    def sleep_latency(self, service, operation):
+        latency = self.latencies.get('{}.{}'.format(service, operation), self.latency_ms)
+        if self.jitter_ms > 0:
+            latency += self.random.uniform(0, self.jitter_ms)
+        if latency > 0:
+            time.sleep(latency / 1000.0)
+
+    def get_caller(self, request_signer):
+        credentials = request_signer._credentials
+        access_key = credentials.get_frozen_credentials().access_key if credentials is not None else ''
+        if access_key.startswith('FAKE'):
+            return access_key[4:16]
+        return MANAGEMENT_ACCOUNT
+
+    # STS
+
+    def sts_get_caller_identity(self, caller, region, params):
+        return {
+            'UserId': 'AIDAFAKE',
+            'Account': caller,
+            'Arn': 'arn:aws:sts::{}:assumed-role/bench/bench'.format(caller)
+        }
+
+    def sts_assume_role(self, caller, region, params):
+        account = params['RoleArn'].split(':')[4]
+        return {
+            'Credentials': {
+                'AccessKeyId': 'FAKE{}{}'.format(account, uuid.uuid4().hex[:4].upper()),
+                'SecretAccessKey': 'fake',
+                'SessionToken': 'fake',
+                'Expiration': datetime.now(timezone.utc) + timedelta(seconds=params.get('DurationSeconds', 3600))
+            },
+            'AssumedRoleUser': {
+                'AssumedRoleId': 'AROAFAKE:{}'.format(params['RoleSessionName']),
+                'Arn': 'arn:aws:sts::{}:assumed-role/{}'.format(account, params['RoleSessionName'])
+            }
+        }
+
+    # Organizations
+
+    def organizations_describe_account(self, caller, region, params):
+        account = self.accounts.get(params['AccountId'])
+        if account is None:
+            raise FakeError('AccountNotFoundException')
+        return { 'Account': self.account_summary(params['AccountId']) }
+
+    def account_summary(self, account_id):
+        return {
+            'Id': account_id,
+            'Arn': 'arn:aws:organizations::{}:account/o-bench/{}'.format(MANAGEMENT_ACCOUNT, account_id),
+            'Email': self.accounts[account_id]['email'],
+            'Name': account_id,
+            'Status': 'ACTIVE'
+        }
+
+    def organizations_list_accounts_for_parent(self, caller, region, params):
+        return {
+            'Accounts': [
+                self.account_summary(account_id) for account_id, account in self.accounts.items()
+                if account['parent'] == params['ParentId']
+            ]
+        }
+
+    def organizations_list_organizational_units_for_parent(self, caller, region, params):
+        return {
+            'OrganizationalUnits': [
+                { 'Id': ou_id, 'Name': ou_id } for ou_id, parent_id in self.parents.items()
+                if parent_id == params['ParentId']
+            ]
+        }
+
+    def organizations_list_parents(self, caller, region, params):
+        account = self.accounts.get(params['ChildId'])
+        if account is None:
+            raise FakeError('ChildNotFoundException')
+        return { 'Parents': [ { 'Id': account['parent'], 'Type': 'ORGANIZATIONAL_UNIT' } ] }
+
+    def organizations_list_accounts(self, caller, region, params):
+        return { 'Accounts': [self.account_summary(account_id) for account_id in self.accounts] }
+
+    # CloudFormation
+
+    def cloudformation_list_stack_instances(self, caller, region, params):
+        # every account is enrolled in all Control Tower regions
+        accounts = [params['StackInstanceAccount']] if 'StackInstanceAccount' in params else list(self.accounts)
+        return {
+            'Summaries': [
+                {
+                    'StackSetId': '{}:bench'.format(params['StackSetName']),
+                    'Region': ct_region,
+                    'Account': account_id,
+                    'Status': 'CURRENT'
+                } for account_id in accounts for ct_region in self.ct_regions
+            ]
+        }
+
+    # Step Functions
+
+    def stepfunctions_list_state_machines(self, caller, region, params):
+        return {
+            'stateMachines': [
+                {
+                    'stateMachineArn': arn,
+                    'name': name,
+                    'type': 'STANDARD',
+                    'creationDate': datetime.now(timezone.utc)
+                } for name, arn in self.state_machines.items()
+            ]
+        }
+
+    def stepfunctions_start_execution(self, caller, region, params):
+        for execution in self.executions:
+            if execution['name'] == params['name']:
+                raise FakeError('ExecutionAlreadyExists')
+        execution_arn = params['stateMachineArn'].replace(':stateMachine:', ':execution:') + ':' + params['name']
+        self.executions.append({ 'name': params['name'], 'arn': execution_arn, 'input': params.get('input') })
+        return { 'executionArn': execution_arn, 'startDate': datetime.now(timezone.utc) }
+
+    # EventBridge
+
+    def events_put_events(self, caller, region, params):
+        if len(params['Entries']) > 10:
+            raise FakeError('ValidationException', 'Entries must have length less than or equal to 10')
+        entries = []
+        failed = 0
+        for entry in params['Entries']:
+            if self.event_failure_rate > 0 and self.random.random() < self.event_failure_rate:
+                entries.append({ 'ErrorCode': 'InternalFailure', 'ErrorMessage': 'Internal failure' })
+                failed += 1
+                continue
+            self.events.append(entry)
+            entries.append({ 'EventId': uuid.uuid4().hex })
+        return { 'FailedEntryCount': failed, 'Entries': entries }
+
+    # DynamoDB
+
+    def dynamodb_update_item(self, caller, region, params):
+        # ADD counters and SET values, enough for the shared rate limiter
+        key = (params['TableName'], params['Key']['pk']['S'])
+        item = self.items.setdefault(key, { 'pk': params['Key']['pk'] })
+        values = params.get('ExpressionAttributeValues', {})
+        for clause in re.findall(r'(ADD|SET) ([^A-Z]+?)(?= ADD | SET |$)', params['UpdateExpression']):
+            for assignment in clause[1].split(','):
+                if clause[0] == 'ADD':
+                    name, value = assignment.split()
+                    current = int(item.get(name, { 'N': '0' })['N'])
+                    item[name] = { 'N': str(current + int(values[value]['N'])) }
+                else:
+                    name, value = [part.strip() for part in assignment.split('=')]
+                    item[name] = values[value]
+        return { 'Attributes': dict(item) }
+
+    # SecurityHub
+
+    def get_hub(self, account, region):
+        hub = self.hubs.get((account, region))
+        if hub is None:
+            raise FakeError('InvalidAccessException', 'Account {} is not subscribed to AWS Security Hub'.format(account), 401)
+        return hub
+
+    def securityhub_describe_hub(self, caller, region, params):
+        self.get_hub(caller, region)
+        return {
+            'HubArn': 'arn:aws:securityhub:{}:{}:hub/default'.format(region, caller),
+            'SubscribedAt': '2021-01-01T00:00:00.000Z',
+            'AutoEnableControls': True
+        }
+
+    def securityhub_enable_security_hub(self, caller, region, params):
+        if (caller, region) in self.hubs:
+            raise FakeError('ResourceConflictException', 'Account {} is already subscribed to Security Hub'.format(caller), 409)
+        hub = { 'standards': {}, 'members': {}, 'administrator': None }
+        if params.get('EnableDefaultStandards', True):
+            for standard in STANDARDS:
+                self.subscribe_standard(hub, caller, region, standard.format(region=region))
+        self.hubs[(caller, region)] = hub
+        return {}
+
+    def subscribe_standard(self, hub, account, region, standard_arn):
+        subscription_arn = 'arn:aws:securityhub:{}:{}:subscription/{}'.format(
+            region, account, standard_arn.split('/', 1)[1])
+        hub['standards'][standard_arn] = subscription_arn
+
+    def standards_subscriptions(self, hub, standard_arns=None):
+        return [
+            {
+                'StandardsSubscriptionArn': subscription_arn,
+                'StandardsArn': standard_arn,
+                'StandardsInput': {},
+                'StandardsStatus': 'READY'
+            } for standard_arn, subscription_arn in hub['standards'].items()
+            if standard_arns is None or standard_arn in standard_arns
+        ]
+
+    def securityhub_get_enabled_standards(self, caller, region, params):
+        return { 'StandardsSubscriptions': self.standards_subscriptions(self.get_hub(caller, region)) }
+
+    def securityhub_batch_enable_standards(self, caller, region, params):
+        hub = self.get_hub(caller, region)
+        standard_arns = [request['StandardsArn'] for request in params['StandardsSubscriptionRequests']]
+        for standard_arn in standard_arns:
+            self.subscribe_standard(hub, caller, region, standard_arn)
+        return { 'StandardsSubscriptions': self.standards_subscriptions(hub, standard_arns) }
+
+    def securityhub_batch_disable_standards(self, caller, region, params):
+        hub = self.get_hub(caller, region)
+        disabled = []
+        for standard_arn, subscription_arn in list(hub['standards'].items()):
+            if subscription_arn in params['StandardsSubscriptionArns']:
+                del hub['standards'][standard_arn]
+                disabled.append({
+                    'StandardsSubscriptionArn': subscription_arn,
+                    'StandardsArn': standard_arn,
+                    'StandardsInput': {},
+                    'StandardsStatus': 'DELETING'
+                })
+        return { 'StandardsSubscriptions': disabled }
+
+    def securityhub_get_findings(self, caller, region, params):
+        self.get_hub(caller, region)
+        return { 'Findings': [] }
+
+    def securityhub_create_members(self, caller, region, params):
+        hub = self.get_hub(caller, region)
+        for details in params['AccountDetails']:
+            if self.organization_admins.get(region) == caller and details['AccountId'] in self.accounts:
+                self.enroll_organization_account(caller, region, details['AccountId'])
+            member = hub['members'].setdefault(details['AccountId'], { 'MemberStatus': 'Created' })
+            member['Email'] = details.get('Email', '')
+        return { 'UnprocessedAccounts': [] }
+
+    def securityhub_get_members(self, caller, region, params):
+        hub = self.get_hub(caller, region)
+        members = []
+        unprocessed = []
+        for account_id in params['AccountIds']:
+            member = hub['members'].get(account_id)
+            if member is None:
+                unprocessed.append({ 'AccountId': account_id, 'ProcessingResult': 'Account is not a member' })
+                continue
+            members.append({
+                'AccountId': account_id,
+                'Email': member.get('Email', ''),
+                'AdministratorId': caller,
+                'MemberStatus': member['MemberStatus']
+            })
+        return { 'Members': members, 'UnprocessedAccounts': unprocessed }
+
+    # SecurityHub organization mode
+
+    def enroll_organization_account(self, administrator, region, account_id):
+        # organization accounts are enabled and associated without invitation
+        if (account_id, region) not in self.hubs:
+            hub = { 'standards': {}, 'members': {}, 'administrator': None }
+            if self.organization_configs.get((administrator, region), {}).get('AutoEnableStandards', 'DEFAULT') == 'DEFAULT':
+                for standard in STANDARDS:
+                    self.subscribe_standard(hub, account_id, region, standard.format(region=region))
+            self.hubs[(account_id, region)] = hub
+        self.hubs[(account_id, region)]['administrator'] = administrator
+        member = self.hubs[(administrator, region)]['members'].setdefault(account_id, {})
+        member.update(MemberStatus='Enabled', Email=self.accounts[account_id]['email'])
+
+    def securityhub_enable_organization_admin_account(self, caller, region, params):
+        if caller != MANAGEMENT_ACCOUNT:
+            raise FakeError('AccessDeniedException', 'Only the organization management account can designate an administrator', 403)
+        administrator = params['AdminAccountId']
+        self.organization_admins[region] = administrator
+        if (administrator, region) not in self.hubs:
+            self.securityhub_enable_security_hub(administrator, region, {})
+        self.organization_configs.setdefault((administrator, region), { 'AutoEnable': False, 'AutoEnableStandards': 'DEFAULT' })
+        return {}
+
+    def securityhub_list_organization_admin_accounts(self, caller, region, params):
+        administrator = self.organization_admins.get(region)
+        return { 'AdminAccounts': [{ 'AccountId': administrator, 'Status': 'ENABLED' }] if administrator else [] }
+
+    def get_organization_config(self, caller, region):
+        if self.organization_admins.get(region) != caller:
+            raise FakeError('InvalidAccessException', 'Account {} is not the administrator of the organization'.format(caller), 401)
+        return self.organization_configs[(caller, region)]
+
+    def securityhub_describe_organization_configuration(self, caller, region, params):
+        configuration = self.get_organization_config(caller, region)
+        return dict(configuration, MemberAccountLimitReached=False)
+
+    def securityhub_update_organization_configuration(self, caller, region, params):
+        configuration = self.get_organization_config(caller, region)
+        configuration['AutoEnable'] = params['AutoEnable']
+        configuration['AutoEnableStandards'] = params.get('AutoEnableStandards', configuration['AutoEnableStandards'])
+        return {}
+
+    def securityhub_invite_members(self, caller, region, params):
+        hub = self.get_hub(caller, region)
+        unprocessed = []
+        for account_id in params['AccountIds']:
+            member = hub['members'].get(account_id)
+            if member is None:
+                unprocessed.append({ 'AccountId': account_id, 'ProcessingResult': 'Account is not a member' })
+                continue
+            if member['MemberStatus'] in ('Enabled', 'Associated'):
+                continue
+            member['MemberStatus'] = 'Invited'
+            self.invitations[(account_id, region, caller)] = {
+                'InvitationId': uuid.uuid4().hex,
+                'visible_at': time.time() + self.invite_delay_ms / 1000.0
+            }
+        return { 'UnprocessedAccounts': unprocessed }
+
+    def securityhub_list_members(self, caller, region, params):
+        hub = self.get_hub(caller, region)
+        members = []
+        for account_id, member in hub['members'].items():
+            if params.get('OnlyAssociated', True) and member['MemberStatus'] not in ('Enabled', 'Associated'):
+                continue
+            members.append({
+                'AccountId': account_id,
+                'Email': member.get('Email', ''),
+                'AdministratorId': caller,
+                'MemberStatus': member['MemberStatus']
+            })
+        return { 'Members': members }
+
+    def securityhub_list_invitations(self, caller, region, params):
+        invitations = []
+        for (account_id, invite_region, administrator), invitation in self.invitations.items():
+            if account_id == caller and invite_region == region and invitation['visible_at'] <= time.time():
+                invitations.append({
+                    'AccountId': administrator,
+                    'InvitationId': invitation['InvitationId'],
+                    'MemberStatus': 'Invited'
+                })
+        return { 'Invitations': invitations }
+
+    def securityhub_accept_administrator_invitation(self, caller, region, params):
+        hub = self.get_hub(caller, region)
+        key = (caller, region, params['AdministratorId'])
+        invitation = self.invitations.get(key)
+        if invitation is None or invitation['InvitationId'] != params['InvitationId']:
+            raise FakeError('ResourceNotFoundException', 'Invitation not found', 404)
+        del self.invitations[key]
+        hub['administrator'] = params['AdministratorId']
+        self.hubs[(params['AdministratorId'], region)]['members'][caller]['MemberStatus'] = 'Enabled'
+        return {}
+
+    def securityhub_get_administrator_account(self, caller, region, params):
+        hub = self.get_hub(caller, region)
+        if hub['administrator'] is None:
+            return {}
+        return {
+            'Administrator': {
+                'AccountId': hub['administrator'],
+                'MemberStatus': 'Enabled'
+            }
+        }
+
+    # reporting
+
+    def call_counts(self):
+        with self.lock:
+            return dict(self.calls), dict(self.throttles)
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+#
+# Offline end-to-end onboarding benchmark for the SecurityHub Enabler.
+# Enrols N accounts across M Control Tower regions against the in-process
+# AWS stand-in (bench/fake_aws.py): the launcher handles one
+# CreateManagedAccount event per account, then every started execution
+# is run the way the State Machine would run it, and SHEnablerEvent
+# sends the completion event.
+#
+# Reports wall time, API calls and throttles per service and operation,
+# and p50/p99 duration per step.
+#
+# Usage:
+#   python3 bench/onboarding.py --accounts 10 --regions 16 --latency-ms 30 \
+#       --throttle-rate 0.01 --shape map --map-concurrency 1
+# Shapes:
+#   map      - Map of Regions with Enable Member, Add Member, Accept Invite (sh_enabler_sm_event-3.json)
+#   fanout   - every step receives the whole Region list (sh_enabler_sm_fanout.json)
+#   pipeline - Map of Regions with SecurityHubAccountPipeline (sh_enabler_sm_pipeline.json)
+#
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIRECTORY, '..', 'src'))
+sys.path.insert(0, BENCH_DIRECTORY)
+
+REGIONS = [
+    'us-east-1', 'us-east-2', 'us-west-1', 'us-west-2', 'ca-central-1',
+    'eu-west-1', 'eu-west-2', 'eu-west-3', 'eu-central-1', 'eu-north-1',
+    'ap-south-1', 'ap-northeast-1', 'ap-northeast-2', 'ap-southeast-1',
+    'ap-southeast-2', 'sa-east-1'
+]
+
+ORG_UNIT_ID = 'ou-bnch-00000001'
+SH_ADMIN_ACCOUNT = '222222222222'
+STATE_MACHINE = 'SHEnablerSM'
+
+class FakeContext:
+    def __init__(self, function_name, timeout_seconds=900):
+        self.function_name = function_name
+        self.invoked_function_arn = 'arn:aws:lambda:us-east-1:111111111111:function:{}'.format(function_name)
+        self.aws_request_id = function_name
+        self.deadline = time.time() + timeout_seconds
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.time()) * 1000)
+
+class StepTimer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = defaultdict(list)
+
+    def run(self, step, handler, event):
+        started = time.perf_counter()
+        try:
+            return handler(event, FakeContext(step))
+        finally:
+            with self.lock:
+                self.durations[step].append((time.perf_counter() - started) * 1000)
+
+def configure_environment(args):
+    os.environ.update({
+        'AWS_ACCESS_KEY_ID': 'testing',
+        'AWS_SECRET_ACCESS_KEY': 'testing',
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'AWS_EC2_METADATA_DISABLED': 'true',
+        'org_id': 'o-bench00000',
+        'ct_home_region': 'us-east-1',
+        'sh_admin_account': SH_ADMIN_ACCOUNT,
+        'assume_role': 'AWSControlTowerExecution',
+        'compliance_frequency': '7',
+        'enable_aws_standard': 'yes',
+        'enable_cis_standard': 'yes',
+        'sm_name': STATE_MACHINE,
+        'event_bus': 'default',
+        'fan_out_max_workers': str(args.fan_out_workers),
+        'enrolment_mode': args.enrolment_mode,
+        'event_mode': args.event_mode
+    })
+    if args.rate_limiter == 'off':
+        os.environ['rate_limit_enabled'] = 'no'
+    else:
+        os.environ['rate_limit_backend'] = args.rate_limiter
+        os.environ['rate_limit_location'] = 'sh-enabler-rate-limits'
+
+def ct_event(account_id, index):
+    return {
+        'id': 'bench-{:06d}'.format(index),
+        'detail': {
+            'eventName': 'CreateManagedAccount',
+            'serviceEventDetails': {
+                'createManagedAccountStatus': {
+                    'state': 'SUCCEEDED',
+                    'account': { 'accountId': account_id },
+                    'organizationalUnit': { 'organizationalUnitId': ORG_UNIT_ID }
+                }
+            }
+        }
+    }
+
+def run_execution(timer, handlers, items, shape, map_concurrency):
+    if shape == 'fanout':
+        output = timer.run('enable_member', handlers['sh_member_enabler'].lambda_handler, items)
+        output = timer.run('add_member', handlers['sh_admin_enabler'].lambda_handler, output)
+        output = timer.run('accept_invite', handlers['sh_member_invite'].lambda_handler, output)
+    else:
+        def iteration(item):
+            if shape == 'pipeline':
+                return timer.run('account_pipeline', handlers['sh_account_pipeline'].lambda_handler, item)
+            output = timer.run('enable_member', handlers['sh_member_enabler'].lambda_handler, item)
+            output = timer.run('add_member', handlers['sh_admin_enabler'].lambda_handler, output)
+            return timer.run('accept_invite', handlers['sh_member_invite'].lambda_handler, output)
+        with ThreadPoolExecutor(max_workers=map_concurrency) as executor:
+            output = list(executor.map(iteration, items))
+    return timer.run('send_event', handlers['sh_enabler_event'].lambda_handler, output)
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def build_report(args, fake, timer, wall_seconds):
+    calls, throttles = fake.call_counts()
+    items = args.accounts * args.regions
+    succeeded = sum(1 for account, region in fake.hubs if account != SH_ADMIN_ACCOUNT and fake.hubs[(account, region)]['administrator'] == SH_ADMIN_ACCOUNT)
+    return {
+        'accounts': args.accounts,
+        'regions': args.regions,
+        'shape': args.shape,
+        'enrolment_mode': args.enrolment_mode,
+        'wall_seconds': round(wall_seconds, 3),
+        'associated_members': '{}/{}'.format(succeeded, items),
+        'executions': len(fake.executions),
+        'events': len(fake.events),
+        'api_calls': sum(calls.values()),
+        'throttles': sum(throttles.values()),
+        'calls': {
+            '{}.{}'.format(service, operation): {
+                'calls': count,
+                'throttles': throttles.get((service, operation), 0)
+            } for (service, operation), count in sorted(calls.items())
+        },
+        'steps': {
+            step: {
+                'count': len(durations),
+                'p50_ms': round(statistics.median(durations), 1),
+                'p99_ms': round(percentile(durations, 0.99), 1)
+            } for step, durations in timer.durations.items()
+        }
+    }
+
+def print_report(report):
+    print('Accounts: {} Regions: {} Shape: {} Enrolment: {}'.format(report['accounts'], report['regions'], report['shape'], report['enrolment_mode']))
+    print('Wall time: {}s  Executions: {}  Events: {}  Associated members: {}'.format(
+        report['wall_seconds'], report['executions'], report['events'], report['associated_members']))
+    print('API calls: {}  Throttled: {}'.format(report['api_calls'], report['throttles']))
+    print()
+    print('{:<52} {:>8} {:>10}'.format('operation', 'calls', 'throttled'))
+    for operation, counts in report['calls'].items():
+        print('{:<52} {:>8} {:>10}'.format(operation, counts['calls'], counts['throttles']))
+    print()
+    print('{:<20} {:>8} {:>12} {:>12}'.format('step', 'count', 'p50', 'p99'))
+    for step, timings in report['steps'].items():
+        print('{:<20} {:>8} {:>10.1f}ms {:>10.1f}ms'.format(step, timings['count'], timings['p50_ms'], timings['p99_ms']))
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline onboarding benchmark for the SecurityHub Enabler')
+    parser.add_argument('--accounts', type=int, default=5)
+    parser.add_argument('--regions', type=int, default=len(REGIONS), help='at most {}'.format(len(REGIONS)))
+    parser.add_argument('--shape', choices=['map', 'fanout', 'pipeline'], default='map')
+    parser.add_argument('--map-concurrency', type=int, default=1, help='MaxConcurrency of the Map of Regions')
+    parser.add_argument('--execution-concurrency', type=int, default=1, help='executions running at once')
+    parser.add_argument('--fan-out-workers', type=int, default=8, help='fan_out_max_workers of the handlers')
+    parser.add_argument('--latency-ms', type=float, default=20, help='latency of every API call')
+    parser.add_argument('--jitter-ms', type=float, default=10, help='random extra latency per API call')
+    parser.add_argument('--latency', action='append', default=[], metavar='SERVICE.Operation=MS',
+        help='latency override for one operation, e.g. securityhub.GetFindings=300')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='probability that a call is throttled')
+    parser.add_argument('--api-limits', action='store_true', help='throttle calls over the published SecurityHub rate limits')
+    parser.add_argument('--rate-limiter', choices=['local', 'dynamodb', 'off'], default='local', help='client-side rate limiter backend')
+    parser.add_argument('--enrolment-mode', choices=['invite', 'organization'], default='invite',
+        help='per-account invitations or organization auto-enable')
+    parser.add_argument('--event-mode', choices=['account', 'batch'], default='account',
+        help='one completion event per account, or summary events per execution')
+    parser.add_argument('--event-failure-rate', type=float, default=0.0, help='probability that a PutEvents entry fails')
+    parser.add_argument('--invite-delay-ms', type=float, default=0, help='invitation propagation delay')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    configure_environment(args)
+    from fake_aws import FakeAws
+    from sh_rate_limit import DEFAULT_RATE_LIMITS
+    fake = FakeAws(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        throttle_rate=args.throttle_rate,
+        invite_delay_ms=args.invite_delay_ms,
+        event_failure_rate=args.event_failure_rate,
+        latencies={ key: float(value) for key, value in (override.split('=') for override in args.latency) },
+        rate_limits=DEFAULT_RATE_LIMITS if args.api_limits else None,
+        seed=args.seed
+    )
+    fake.install()
+    fake.ct_regions = REGIONS[:args.regions]
+    fake.add_state_machine(STATE_MACHINE)
+    account_ids = ['{:012d}'.format(300000000000 + index) for index in range(args.accounts)]
+    for account_id in account_ids:
+        fake.add_account(account_id, 'bench+{}@example.com'.format(account_id), ORG_UNIT_ID)
+
+    import sh_account_pipeline
+    import sh_admin_enabler
+    import sh_enabler_event
+    import sh_member_enabler
+    import sh_member_invite
+    import sh_sm_launcher
+    handlers = {
+        'sh_account_pipeline': sh_account_pipeline,
+        'sh_admin_enabler': sh_admin_enabler,
+        'sh_enabler_event': sh_enabler_event,
+        'sh_member_enabler': sh_member_enabler,
+        'sh_member_invite': sh_member_invite
+    }
+
+    timer = StepTimer()
+    started = time.perf_counter()
+    for index, account_id in enumerate(account_ids):
+        timer.run('launcher', sh_sm_launcher.lambda_handler, ct_event(account_id, index))
+    with ThreadPoolExecutor(max_workers=args.execution_concurrency) as executor:
+        list(executor.map(
+            lambda execution: run_execution(timer, handlers, json.loads(execution['input']), args.shape, args.map_concurrency),
+            list(fake.executions)
+        ))
+    wall_seconds = time.perf_counter() - started
+
+    report = build_report(args, fake, timer, wall_seconds)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+if __name__ == '__main__':
+    main()
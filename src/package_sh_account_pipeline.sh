@@ -0,0 +1,10 @@
+#!/bin/bash
+SCRIPT_DIRECTORY="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
+
+pushd $SCRIPT_DIRECTORY > /dev/null
+
+rm -rf .package sh_account_pipeline.zip
+
+zip sh_account_pipeline.zip sh_account_pipeline.py sh_admin_enabler.py sh_member_enabler.py sh_member_invite.py sh_clients.py sh_metrics.py sh_credentials.py sh_fanout.py sh_journal.py sh_member_index.py sh_hub_state.py sh_organization.py sh_payload.py sh_plan.py sh_rate_limit.py sh_standards.py sh_store.py
+
+popd > /dev/null
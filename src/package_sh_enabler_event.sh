@@ -5,6 +5,6 @@ pushd $SCRIPT_DIRECTORY > /dev/null
 
 rm -rf .package sh_enabler_event.zip
 
-zip sh_enabler_event.zip sh_enabler_event.py
+zip sh_enabler_event.zip sh_enabler_event.py sh_clients.py sh_metrics.py
 
 popd > /dev/null
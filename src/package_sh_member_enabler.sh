@@ -5,6 +5,6 @@ pushd $SCRIPT_DIRECTORY > /dev/null
 
 rm -rf .package sh_member_enabler.zip
 
-zip sh_member_enabler.zip sh_member_enabler.py
+zip sh_member_enabler.zip sh_member_enabler.py sh_clients.py sh_metrics.py sh_credentials.py sh_fanout.py sh_journal.py sh_member_index.py sh_organization.py sh_payload.py sh_plan.py sh_rate_limit.py sh_standards.py sh_store.py
 
 popd > /dev/null
@@ -0,0 +1,138 @@
+import json
+import os
+import time
+import logging
+from sh_credentials import assume_role
+from sh_fanout import fan_out
+from sh_member_index import ASSOCIATED_STATUSES, get_fresh_after, get_member_status, seed_member_index
+from sh_metrics import metrics_handler
+from sh_organization import is_organization_mode
+from sh_payload import is_compact, iter_items, to_delta
+from sh_plan import get_planned_member_statuses, is_planned
+import sh_admin_enabler
+import sh_member_enabler
+import sh_member_invite
+
+LOGGER = logging.getLogger()
+if 'log_level' in os.environ:
+    LOGGER.setLevel(os.environ['log_level'])
+    print('Log level set to %s' % LOGGER.getEffectiveLevel())
+else:
+    LOGGER.setLevel(logging.ERROR)
+
+#
+# Runs Enable Member, Add Member and Accept Invite for an account-region
+# item in one invocation, sharing the assumed-role sessions and clients.
+# Accepts one item or the whole region list (fan-out mode).
+#
+# Environment Variables
+# pipeline_skip_stages (optional, comma separated stage names)
+#
+
+# globals
+STAGE_ENABLE_MEMBER = 'enable_member'
+STAGE_ADD_MEMBER = 'add_member'
+STAGE_ACCEPT_INVITE = 'accept_invite'
+
+# assumed-role sessions come from the shared credential cache on first use,
+# so a skipped stage costs no assume_role
+def member_session(item):
+    return assume_role(item['org_id'], item['member_account'], item['assume_role'])
+
+def admin_session(item):
+    return assume_role(item['org_id'], item['sh_admin_account'], item['assume_role'])
+
+def enable_member_stage(item, deadline):
+    if is_organization_mode(item):
+        # enabled by organization auto-enable or the Admin's create_members,
+        # accept_invite_stage enables the accounts the Admin cannot associate
+        return { 'status': 'SUCCEEDED', 'organization': True }
+    if not is_planned(item, STAGE_ENABLE_MEMBER):
+        return { 'status': 'SUCCEEDED', 'planned': False }
+    security_standards = [ { 'aws': item['enable_aws_standard'], 'cis': item['enable_cis_standard'] } ]
+    enabled = sh_member_enabler.enable_security_hub(member_session(item), item['member_account'],
+        item['member_region'], security_standards, use_journal=not item.get('skip_journal', False))
+    return { 'status': 'SUCCEEDED' if enabled else 'FAILED' }
+
+def add_member_stage(item, deadline):
+    sh_admin_session = admin_session(item)
+    security_standards = [ { 'aws': item['enable_aws_standard'], 'cis': item['enable_cis_standard'] } ]
+    sh_admin_enabler.enable_admin(sh_admin_session, item['sh_admin_account'], item['member_region'], security_standards)
+    planned_statuses = get_planned_member_statuses(item)
+    if planned_statuses is not None:
+        seed_member_index(item['sh_admin_account'], item['member_region'], planned_statuses)
+    if not is_planned(item, STAGE_ADD_MEMBER):
+        return { 'status': 'SUCCEEDED', 'planned': False }
+    unprocessed_accounts = sh_admin_enabler.add_member(sh_admin_session, item['sh_admin_account'],
+        item['member_region'], item['member_account'], item['member_email'],
+        use_journal=not item.get('skip_journal', False), organization=is_organization_mode(item),
+        fresh_after=get_fresh_after(item))
+    return {
+        'status': 'FAILED' if len(unprocessed_accounts) > 0 else 'SUCCEEDED',
+        'unprocessed_accounts': unprocessed_accounts
+    }
+
+def accept_invite_stage(item, deadline):
+    if not is_planned(item, STAGE_ACCEPT_INVITE):
+        return { 'status': 'SUCCEEDED', 'planned': False }
+    if get_member_status(admin_session(item), item['sh_admin_account'],
+            item['member_region'], item['member_account']) in ASSOCIATED_STATUSES:
+        return { 'status': 'SUCCEEDED', 'invite_outcome': sh_member_invite.OUTCOME_ALREADY_ASSOCIATED }
+    if is_organization_mode(item) and not sh_member_invite.enable_organization_fallback(member_session(item), item):
+        return { 'status': 'FAILED', 'invite_outcome': sh_member_invite.OUTCOME_FAILED, 'organization_fallback': True }
+    outcome = sh_member_invite.accept_invitation(member_session(item), item['member_account'],
+        item['sh_admin_account'], item['member_region'], deadline,
+        use_journal=not item.get('skip_journal', False))
+    return {
+        'status': 'SUCCEEDED' if outcome in (sh_member_invite.OUTCOME_ACCEPTED, sh_member_invite.OUTCOME_ALREADY_ASSOCIATED) else 'FAILED',
+        'invite_outcome': outcome
+    }
+
+STAGES = [
+    (STAGE_ENABLE_MEMBER, enable_member_stage),
+    (STAGE_ADD_MEMBER, add_member_stage),
+    (STAGE_ACCEPT_INVITE, accept_invite_stage)
+]
+
+def get_skip_stages(event):
+    skip_stages = set(event.get('skip_stages', [])) if isinstance(event, dict) else set()
+    if os.environ.get('pipeline_skip_stages'):
+        skip_stages.update(stage.strip() for stage in os.environ['pipeline_skip_stages'].split(','))
+    return skip_stages
+
+def run_pipeline(item, skip_stages, deadline):
+    stages = {}
+    status = 'SUCCEEDED'
+    for name, stage in STAGES:
+        if name in skip_stages:
+            stages[name] = { 'status': 'SKIPPED', 'duration_ms': 0 }
+            continue
+        started = time.time()
+        try:
+            result = stage(item, deadline)
+        except Exception as e:
+            print('Stage: {} failed for Account: {} in Region: {}'.format(name, item['member_account'], item['member_region']))
+            print(str(e))
+            result = { 'status': 'FAILED', 'error': str(e) }
+        result['duration_ms'] = int((time.time() - started) * 1000)
+        print('Stage: {} {} for Account: {} in Region: {} in {} ms'.format(
+            name, result['status'], item['member_account'], item['member_region'], result['duration_ms']
+        ))
+        if result['status'] == 'FAILED':
+            status = 'FAILED'
+        stages[name] = result
+    return dict(item, statusCode=200, status=status, stages=stages)
+
+@metrics_handler
+def lambda_handler(event, context):
+    print(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
+    skip_stages = get_skip_stages(event)
+    deadline = sh_member_invite.get_deadline(context)
+    # compact mode: expand the item(s) lazily, return only the deltas
+    if is_compact(event):
+        deltas = [to_delta(result) for result in fan_out(list(iter_items(event)), lambda item: run_pipeline(item, skip_stages, deadline))]
+        return deltas[0] if 'item' in event else { 'results': deltas }
+    # fan-out mode: event is the whole region list built by sh_sm_launcher.prepare_input
+    if isinstance(event, list):
+        return fan_out(event, lambda item: run_pipeline(item, skip_stages, deadline))
+    return run_pipeline(event, skip_stages, deadline)
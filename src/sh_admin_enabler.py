@@ -1,11 +1,19 @@
-import sys
-import boto3
 import json
-import urllib3
 import os
 import logging
-from datetime import date, datetime
-from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from sh_clients import get_client
+from sh_credentials import assume_role
+from sh_fanout import fan_out
+from sh_hub_state import is_hub_enabled, set_hub_enabled
+from sh_journal import STEP_ADD_MEMBER, get_checkpoint, record_checkpoint
+from sh_member_index import ASSOCIATED_STATUSES, CREATE_STATUSES, INVITE_STATUSES, get_fresh_after, get_member_index, get_member_status, seed_member_index, set_member_status
+from sh_metrics import metrics_handler
+from sh_organization import get_org_member_statuses, is_organization_mode
+from sh_payload import is_compact, iter_items, to_delta
+from sh_plan import get_planned_member_statuses, is_planned
+from sh_rate_limit import install_rate_limiter
+from sh_standards import reconcile_standards
 
 LOGGER = logging.getLogger()
 if 'log_level' in os.environ:
@@ -14,176 +22,90 @@ if 'log_level' in os.environ:
 else:
     LOGGER.setLevel(logging.ERROR)
 
-session = boto3.Session()
-
 # globals
-
-def json_serial(obj):
-    if isinstance(obj, (datetime, date)):
-        return obj.isoformat()
-    raise TypeError('Type %s not serializable' % type(obj))
-
-def assume_role(org_id, aws_account_number, role_name):
-    sts_client = boto3.client('sts')
-    partition = sts_client.get_caller_identity()['Arn'].split(":")[1]
-    response = sts_client.assume_role(
-        RoleArn='arn:%s:iam::%s:role/%s' % (
-            partition, aws_account_number, role_name
-        ),
-        RoleSessionName=str(aws_account_number+'-'+role_name),
-        ExternalId=org_id
-    )
-    sts_session = boto3.Session(
-        aws_access_key_id=response['Credentials']['AccessKeyId'],
-        aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-        aws_session_token=response['Credentials']['SessionToken']
-    )
-    print(f"Assumed region_session for Account {aws_account_number}")
-    return sts_session
+# SecurityHub calls of all threads wait for their (account, region, operation) rate limit
+install_rate_limiter()
+# CreateMembers / InviteMembers accept at most 50 accounts per call
+MEMBER_BATCH_SIZE = int(os.environ.get('member_batch_size', 50))
+# Regions processed at once by the admin engine
+ADMIN_MAX_CONCURRENCY = int(os.environ.get('admin_max_concurrency', 8))
 
 def enable_admin(sh_admin_session, sh_admin_account, region, security_standards):
     try:
-        sh_admin_client = sh_admin_session.client('securityhub', 
-        endpoint_url=f"https://securityhub.{region}.amazonaws.com", 
-        region_name=region)
-        # make inexpensive call as much possible
-        paginator = sh_admin_client.get_paginator('get_findings')
-        filters = {
-            'AwsAccountId': [
-                {
-                    'Value': sh_admin_account,
-                    'Comparison': 'EQUALS'
-                }
-            ],
-            'Region': [
-                {
-                    'Value': region,
-                    'Comparison': 'EQUALS'
-                }
-            ]
-        }
-        iterator = paginator.paginate(Filters=filters)
-        findings = []
-        for page in iterator:
-            for finding in page['Findings']:
-                findings.append(finding)
-            # break on 1st page
-            break
-        if len(findings) > 0:
-            print("Findings: {} found Region: {}".format(len(findings), region))
+        # cheap DescribeHub probe, cached per (account, region) in the container
+        if is_hub_enabled(sh_admin_session, sh_admin_account, region):
+            print("SecurityHub already enabled on Account: {} in Region: {}".format(sh_admin_account, region))
         else:
-            # no findings is assumed SecurityHub is not enabled
-            print("No findings. Enable SecurityHub Admin ..")
+            print("SecurityHub not enabled. Enable SecurityHub Admin ..")
+            sh_admin_client = get_client(sh_admin_session, 'securityhub', region)
             try:
                 sh_admin_client.enable_security_hub(EnableDefaultStandards=False)
+                set_hub_enabled(sh_admin_account, region)
                 print("Enabled SecurityHub on Account: {} in Region: {}".format(sh_admin_account, region))
                 # enable standards
-                standards = process_security_standards(sh_admin_session, sh_admin_account, region, security_standards)
+                process_security_standards(sh_admin_session, sh_admin_account, region, security_standards)
             except Exception as ex:
                 print("Failed to enable SecurityHub on Account: {} in Region: {}".format(sh_admin_account, region))
-                print(str(e))
+                print(str(ex))
     except Exception as e:
         print("Failed to enable SecurityHub Admin for Account: {} in Region: {}".format(sh_admin_account, region))
         print(str(e))
 
 def process_security_standards(sh_session, sh_account, region, security_standards):
     try:
-        sh_client = sh_session.client('securityhub', 
-            endpoint_url=f"https://securityhub.{region}.amazonaws.com", 
-            region_name=region)
-        # AWS standard ARNs
-        aws_standard_arn = 'arn:aws:securityhub:{}::standards/aws-foundational-security-best-practices/v/1.0.0'.format(region)
-        aws_subscription_arn = 'arn:aws:securityhub:{}:{}:subscription/aws-foundational-security-best-practices/v/1.0.0'.format(region, sh_account)
-        # CIS standard ARNs
-        cis_standard_arn = 'arn:aws:securityhub:::ruleset/cis-aws-foundations-benchmark/v/1.2.0'
-        cis_subscription_arn = 'arn:aws:securityhub:{}:{}:subscription/cis-aws-foundations-benchmark/v/1.2.0'.format(region, sh_account)
-        aws_standard_enabled = False
-        cis_standard_enabled = False
-        enabled_standards = sh_client.get_enabled_standards()
-        for enabled_standard in enabled_standards['StandardsSubscriptions']:
-            if aws_standard_arn in enabled_standard['StandardsArn']:
-                aws_standard_enabled = True
-            if cis_standard_arn in enabled_standard['StandardsArn']:
-                cis_standard_enabled = True
-        for standard in security_standards:
-            if standard['aws'] == 'yes':
-                if aws_standard_enabled:
-                    print('Standard: {} is already enabled in Account: {} in Region: {}'.format(aws_standard_arn, sh_account, region))
-                else:
-                    try:
-                        sh_client.batch_enable_standards(
-                            StandardsSubscriptionRequests=[
-                                {
-                                    'StandardsArn': aws_standard_arn
-                                }
-                            ]
-                        )
-                        print('Standard: {} is enabled in Account: {} in Region: {}'.format(aws_standard_arn, sh_account, region))
-                    except Exception as ex:
-                        print('Failed to enable Standard: {} in Account: {} in Region: {}'.format(aws_standard_arn, sh_account, region))
-                        print(str(ex))
-                        raise ex
-            elif standard['aws'] == 'no':
-                try:
-                    sh_client.batch_disable_standards(StandardsSubscriptionArns=[aws_subscription_arn])
-                    print('Standard: {} is disabled in Account: {} in Region: {}'.format(aws_standard_arn, sh_account, region))
-                except Exception as ex:
-                    print('Failed to disable Standard: {} in Account: {} in Region: {}'.format(aws_standard_arn, sh_account, region))
-                    print(str(ex))
-                    raise ex
-            if standard['cis'] == 'yes':
-                if cis_standard_enabled:
-                    print('Standard: {} is already enabled in Account: {} in Region: {}'.format(cis_standard_arn, sh_account, region))
-                else:
-                    try:
-                        sh_client.batch_enable_standards(
-                            StandardsSubscriptionRequests=[
-                                {
-                                    'StandardsArn': cis_standard_arn
-                                }
-                            ]
-                        )
-                        print('Standard: {} is enabled in Account: {} in Region: {}'.format(cis_standard_arn, sh_account, region))
-                    except Exception as ex:
-                        print('Failed to enable Standard: {} in Account: {} in Region: {}'.format(cis_standard_arn, sh_account, region))
-                        print(str(ex))
-                        raise ex
-            elif standard['cis'] == 'no':
-                try:
-                    sh_client.batch_disable_standards(StandardsSubscriptionArns=[cis_subscription_arn])
-                    print('Standard: {} is disabled in Account: {} in Region: {}'.format(cis_standard_arn, sh_account, region))
-                except Exception as ex:
-                    print('Failed to disable Standard: {} in Account: {} in Region: {}'.format(cis_standard_arn, sh_account, region))
-                    print(str(ex))
-                    raise ex
+        sh_client = get_client(sh_session, 'securityhub', region)
+        reconcile_standards(sh_client, sh_account, region, security_standards)
     except Exception as e:
         print(f"Failed to enable security standards: {e}")
         print(str(e))
     return security_standards
 
-def add_member(sh_admin_session, sh_admin_account, sh_region, member_account, member_email):
+def add_member(sh_admin_session, sh_admin_account, sh_region, member_account, member_email, use_journal=True, organization=False, fresh_after=None):
     unprocessed_accounts = []
+    if use_journal and get_checkpoint(member_account, sh_region, STEP_ADD_MEMBER, sh_admin_account) is not None:
+        return unprocessed_accounts
     try:
-        sh_admin_client = sh_admin_session.client('securityhub',
-        endpoint_url=f"https://securityhub.{sh_region}.amazonaws.com",
-        region_name=sh_region)
-        response = sh_admin_client.create_members(
-            AccountDetails=[
-                {
-                    'AccountId': member_account,
-                    'Email': member_email
-                }
-            ]
-        )
-        if len(response['UnprocessedAccounts']) > 0:
-            unprocessed_accounts = response['UnprocessedAccounts']
-            for unprocessed_account in unprocessed_accounts:
-                print('Account: {} could not be processed by Admin: {} in Region: {}'.format(
-                    unprocessed_account, sh_admin_account, sh_region
-                ))
-        else:
+        sh_admin_client = get_client(sh_admin_session, 'securityhub', sh_region)
+        # only the calls the current member status requires
+        member_status = get_member_status(sh_admin_session, sh_admin_account, sh_region, member_account, fresh_after)
+        if member_status in ASSOCIATED_STATUSES:
+            print('Member: {} is already associated with Admin: {} in Region: {}'.format(member_account, sh_admin_account, sh_region))
+            record_checkpoint(member_account, sh_region, STEP_ADD_MEMBER, sh_admin_account)
+            return unprocessed_accounts
+        if member_status in CREATE_STATUSES:
+            response = sh_admin_client.create_members(
+                AccountDetails=[
+                    {
+                        'AccountId': member_account,
+                        'Email': member_email
+                    }
+                ]
+            )
+            if len(response['UnprocessedAccounts']) > 0:
+                unprocessed_accounts = response['UnprocessedAccounts']
+                for unprocessed_account in unprocessed_accounts:
+                    print('Account: {} could not be processed by Admin: {} in Region: {}'.format(
+                        unprocessed_account, sh_admin_account, sh_region
+                    ))
+                return unprocessed_accounts
             print('API call create_members(..) successful')
+            member_status = 'Created'
+            if organization:
+                # organization accounts are associated by create_members, no invitation
+                member_status = get_org_member_statuses(sh_admin_client, [member_account]).get(member_account, member_status)
+            set_member_status(sh_admin_account, sh_region, member_account, member_status)
+            if member_status in ASSOCIATED_STATUSES:
+                print('Member: {} associated with Admin: {} in Region: {} by the organization'.format(member_account, sh_admin_account, sh_region))
+                record_checkpoint(member_account, sh_region, STEP_ADD_MEMBER, sh_admin_account)
+                return unprocessed_accounts
+        if member_status in INVITE_STATUSES:
             unprocessed_accounts = create_invite(sh_admin_client, sh_admin_account, member_account, sh_region)
+            if len(unprocessed_accounts) > 0:
+                return unprocessed_accounts
+            set_member_status(sh_admin_account, sh_region, member_account, 'Invited')
+        else:
+            print('Member: {} already invited by Admin: {} in Region: {}'.format(member_account, sh_admin_account, sh_region))
+        record_checkpoint(member_account, sh_region, STEP_ADD_MEMBER, sh_admin_account)
     except Exception as e:
         print('Failed to add Member: {} to Admin: {} in Region: {}'.format(member_account, sh_admin_account, sh_region))
         print(str(e))
@@ -207,35 +129,218 @@ def create_invite(sh_admin_client, sh_admin_account, member_account, sh_region):
         print(str(e))
         raise e
 
-def lambda_handler(event, context):
-    print(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
-    org_id = event['org_id']
-    ou_id = event['org_unit_id']
-    ct_home_region = event['ct_home_region']
-    sh_admin_account = event['sh_admin_account']
-    assume_role_name = event['assume_role']
-    compliance_frequency = event['compliance_frequency']
-    enable_aws_standard = event['enable_aws_standard']
-    enable_cis_standard = event['enable_cis_standard']
-    member_account = event['member_account']
-    member_email = event['member_email']
-    member_region = event['member_region']
-    security_standards = [ { 'aws': enable_aws_standard, 'cis': enable_cis_standard } ]
-    sh_admin_session = assume_role(org_id, sh_admin_account, assume_role_name)
-    enabled_regions_standards = enable_admin(sh_admin_session, sh_admin_account, member_region, security_standards)
-    unprocessed_accounts = add_member(sh_admin_session, sh_admin_account, member_region, member_account, member_email)
+def batches(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+def merge_unprocessed(results, unprocessed_accounts, sh_admin_account, sh_region):
+    for unprocessed_account in unprocessed_accounts:
+        print('Account: {} could not be processed by Admin: {} in Region: {}'.format(
+            unprocessed_account, sh_admin_account, sh_region
+        ))
+        results[unprocessed_account['AccountId']] = {
+            'status': 'FAILED',
+            'message': unprocessed_account.get('ProcessingResult', '')
+        }
+
+def add_members(sh_admin_session, sh_admin_account, sh_region, members, organization=False, use_journal=True, fresh_after=None, plan_id=None):
+    # members: list of { 'account': .., 'email': .. }
+    # returns { account: { 'status': 'ASSOCIATED' | 'INVITED' | 'SKIPPED' | 'FAILED', 'message': .. } }
+    # same rules as add_member: planned steps only, journal unless use_journal is off
+    results = {}
+    region_item = { 'plan_id': plan_id, 'member_region': sh_region }
+    planned_statuses = get_planned_member_statuses(region_item)
+    if planned_statuses is not None:
+        seed_member_index(sh_admin_account, sh_region, planned_statuses)
+    for member in members:
+        if not is_planned(dict(region_item, member_account=member['account']), STEP_ADD_MEMBER):
+            results[member['account']] = { 'status': 'SKIPPED', 'message': 'plan' }
+        elif use_journal and get_checkpoint(member['account'], sh_region, STEP_ADD_MEMBER, sh_admin_account) is not None:
+            results[member['account']] = { 'status': 'SKIPPED', 'message': 'journal' }
+    statuses = {}
+    if len(results) < len(members):
+        index = get_member_index(sh_admin_session, sh_admin_account, sh_region, fresh_after)
+        statuses = {
+            member['account']: index.get(member['account'])
+            for member in members if member['account'] not in results
+        }
+    for member_account, member_status in statuses.items():
+        if member_status in ASSOCIATED_STATUSES:
+            results[member_account] = { 'status': 'ASSOCIATED', 'message': '' }
+            record_checkpoint(member_account, sh_region, STEP_ADD_MEMBER, sh_admin_account)
+        elif member_status not in INVITE_STATUSES:
+            results[member_account] = { 'status': 'INVITED', 'message': 'already invited' }
+    members = [member for member in members if member['account'] not in results]
+    sh_admin_client = get_client(sh_admin_session, 'securityhub', sh_region)
+    for batch in batches([member for member in members if statuses[member['account']] in CREATE_STATUSES], MEMBER_BATCH_SIZE):
+        try:
+            response = sh_admin_client.create_members(
+                AccountDetails=[
+                    {
+                        'AccountId': member['account'],
+                        'Email': member['email']
+                    } for member in batch
+                ]
+            )
+            merge_unprocessed(results, response['UnprocessedAccounts'], sh_admin_account, sh_region)
+        except Exception as e:
+            print('Failed to add Members: {} to Admin: {} in Region: {}'.format(
+                [member['account'] for member in batch], sh_admin_account, sh_region
+            ))
+            print(str(e))
+            for member in batch:
+                results[member['account']] = { 'status': 'FAILED', 'message': str(e) }
+    created_accounts = [member['account'] for member in members if member['account'] not in results]
+    print('API call create_members(..) successful for {} of {} Accounts'.format(len(created_accounts), len(members)))
+    if organization:
+        # organization accounts are associated by create_members, the others are invited
+        for batch in batches(created_accounts, MEMBER_BATCH_SIZE):
+            try:
+                for member_account, member_status in get_org_member_statuses(sh_admin_client, batch).items():
+                    set_member_status(sh_admin_account, sh_region, member_account, member_status)
+                    if member_status in ASSOCIATED_STATUSES:
+                        results[member_account] = { 'status': 'ASSOCIATED', 'message': 'organization' }
+                        record_checkpoint(member_account, sh_region, STEP_ADD_MEMBER, sh_admin_account)
+            except Exception as e:
+                print('Failed to get Members: {} of Admin: {} in Region: {}'.format(batch, sh_admin_account, sh_region))
+                print(str(e))
+        created_accounts = [member_account for member_account in created_accounts if member_account not in results]
+    invites = create_invites(sh_admin_client, sh_admin_account, created_accounts, sh_region)
+    for member_account, result in invites.items():
+        if result['status'] == 'INVITED':
+            set_member_status(sh_admin_account, sh_region, member_account, 'Invited')
+            record_checkpoint(member_account, sh_region, STEP_ADD_MEMBER, sh_admin_account)
+    results.update(invites)
+    return results
+
+def create_invites(sh_admin_client, sh_admin_account, member_accounts, sh_region):
+    results = {}
+    for batch in batches(member_accounts, MEMBER_BATCH_SIZE):
+        try:
+            response = sh_admin_client.invite_members(AccountIds=batch)
+            merge_unprocessed(results, response['UnprocessedAccounts'], sh_admin_account, sh_region)
+        except Exception as e:
+            print('Failed to Create Invitation for Members: {} to Admin: {} in Region: {}'.format(batch, sh_admin_account, sh_region))
+            print(str(e))
+            for member_account in batch:
+                results[member_account] = { 'status': 'FAILED', 'message': str(e) }
+    for member_account in member_accounts:
+        if member_account not in results:
+            results[member_account] = { 'status': 'INVITED', 'message': '' }
+    return results
+
+def process_admin_region(sh_admin_session, item):
+    sh_admin_account = item['sh_admin_account']
+    member_account = item['member_account']
+    member_email = item['member_email']
+    member_region = item['member_region']
+    security_standards = [ { 'aws': item['enable_aws_standard'], 'cis': item['enable_cis_standard'] } ]
+    enable_admin(sh_admin_session, sh_admin_account, member_region, security_standards)
+    planned_statuses = get_planned_member_statuses(item)
+    if planned_statuses is not None:
+        # the plan's ListMembers snapshot stands in for the index sweep
+        seed_member_index(sh_admin_account, member_region, planned_statuses)
+    unprocessed_accounts = []
+    if is_planned(item, STEP_ADD_MEMBER):
+        unprocessed_accounts = add_member(sh_admin_session, sh_admin_account, member_region, member_account, member_email,
+            use_journal=not item.get('skip_journal', False), organization=is_organization_mode(item),
+            fresh_after=get_fresh_after(item))
+    else:
+        print('Add Member for Account: {} in Region: {} is not in plan: {}'.format(member_account, member_region, item['plan_id']))
     return {
         'statusCode': 200,
-        'org_id': org_id,
-        'org_unit_id': ou_id,
-        'ct_home_region': ct_home_region,
+        'org_id': item['org_id'],
+        'org_unit_id': item['org_unit_id'],
+        'ct_home_region': item['ct_home_region'],
         'sh_admin_account': sh_admin_account,
-        'assume_role': assume_role_name,
-        'compliance_frequency': compliance_frequency,
-        'enable_aws_standard': enable_aws_standard,
-        'enable_cis_standard': enable_cis_standard,
+        'assume_role': item['assume_role'],
+        'compliance_frequency': item['compliance_frequency'],
+        'enable_aws_standard': item['enable_aws_standard'],
+        'enable_cis_standard': item['enable_cis_standard'],
         'member_account': member_account,
         'member_email': member_email,
         'member_region': member_region,
-        'unprocessed_accounts': unprocessed_accounts
-    }
\ No newline at end of file
+        'skip_journal': item.get('skip_journal', False),
+        'dispatched_at': item.get('dispatched_at'),
+        'enrolment_mode': item.get('enrolment_mode'),
+        'plan_id': item.get('plan_id'),
+        'member_status': get_member_status(sh_admin_session, sh_admin_account, member_region, member_account),
+        'unprocessed_accounts': unprocessed_accounts,
+        # a failed Enable Member stays failed
+        'status': 'FAILED' if item.get('status') == 'FAILED' or len(unprocessed_accounts) > 0 else 'SUCCEEDED'
+    }
+
+def fan_out_regions(items):
+    # one assume_role into the admin account, then all regions at once
+    if len(items) == 0:
+        return []
+    sh_admin_session = assume_role(items[0]['org_id'], items[0]['sh_admin_account'], items[0]['assume_role'])
+    def worker(item):
+        return process_admin_region(sh_admin_session, item)
+    return fan_out(items, worker)
+
+async def process_admin_region_async(loop, executor, semaphore, sh_admin_session, sh_admin_account, region, members, security_standards,
+        organization=False, use_journal=True, fresh_after=None, plan_id=None):
+    # boto3 calls block: run them on the executor, the semaphore bounds the Regions in flight
+    async with semaphore:
+        try:
+            await loop.run_in_executor(executor, enable_admin, sh_admin_session, sh_admin_account, region, security_standards)
+            return region, await loop.run_in_executor(executor, add_members, sh_admin_session, sh_admin_account, region, members,
+                organization, use_journal, fresh_after, plan_id)
+        except Exception as e:
+            print('Failed to process Admin: {} in Region: {}'.format(sh_admin_account, region))
+            print(str(e))
+            return region, { member['account']: { 'status': 'FAILED', 'message': str(e) } for member in members }
+
+async def run_admin_engine(sh_admin_session, sh_admin_account, regions, members, security_standards,
+        organization=False, use_journal=True, fresh_after=None, plan_id=None):
+    # enable_admin, add_members and create_invites for all Regions at once from one Admin session
+    # returns { region: { account: { 'status': .., 'message': .. } } }
+    import asyncio
+    loop = asyncio.get_running_loop()
+    concurrency = max(1, min(ADMIN_MAX_CONCURRENCY, len(regions)))
+    semaphore = asyncio.Semaphore(concurrency)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = await asyncio.gather(*[
+            process_admin_region_async(loop, executor, semaphore, sh_admin_session, sh_admin_account, region, members, security_standards,
+                organization, use_journal, fresh_after, plan_id)
+            for region in regions
+        ])
+    return dict(results)
+
+def bulk_add_members(event):
+    # bulk mode: many (account, email) pairs, or one member_account, added to the Admin in every Region
+    # only the bulk path needs the event loop, keep asyncio out of the per-item cold start
+    import asyncio
+    sh_admin_account = event['sh_admin_account']
+    members = event.get('members', [ { 'account': event.get('member_account'), 'email': event.get('member_email') } ])
+    member_regions = event.get('member_regions', [event.get('member_region')])
+    security_standards = [ { 'aws': event['enable_aws_standard'], 'cis': event['enable_cis_standard'] } ]
+    sh_admin_session = assume_role(event['org_id'], sh_admin_account, event['assume_role'])
+    results = asyncio.run(run_admin_engine(sh_admin_session, sh_admin_account, member_regions, members, security_standards,
+        is_organization_mode(event), not event.get('skip_journal', False), get_fresh_after(event), event.get('plan_id')))
+    return {
+        'statusCode': 200,
+        'org_id': event['org_id'],
+        'sh_admin_account': sh_admin_account,
+        'assume_role': event['assume_role'],
+        'enable_aws_standard': event['enable_aws_standard'],
+        'enable_cis_standard': event['enable_cis_standard'],
+        'member_regions': member_regions,
+        'results': results
+    }
+
+@metrics_handler
+def lambda_handler(event, context):
+    print(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
+    # compact mode: expand the item(s) lazily, return only the deltas
+    if is_compact(event):
+        deltas = [to_delta(result) for result in fan_out_regions(list(iter_items(event)))]
+        return deltas[0] if 'item' in event else { 'results': deltas }
+    # fan-out mode: event is the whole region list built by sh_sm_launcher.prepare_input
+    if isinstance(event, list):
+        return fan_out_regions(event)
+    if 'members' in event or 'member_regions' in event:
+        return bulk_add_members(event)
+    sh_admin_session = assume_role(event['org_id'], event['sh_admin_account'], event['assume_role'])
+    return process_admin_region(sh_admin_session, event)
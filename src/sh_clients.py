@@ -0,0 +1,67 @@
+import os
+import threading
+
+# Shared AWS client factory for the SecurityHub Enabler handlers.
+# Keeps one client per (session, service, region) for the life of a warm
+# Lambda container, so per-Region steps reuse the loaded service model and
+# the open HTTPS connections of the client.
+#
+# Environment Variables
+# client_max_pool_connections (optional, default 10)
+# client_tcp_keepalive (optional, default yes)
+# client_retry_mode (optional, default adaptive)
+# client_max_attempts (optional, default 5)
+# aws_endpoint_url (optional, send all calls to a local AWS stand-in)
+#
+
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+DEFAULT_RETRY_MODE = 'adaptive'
+DEFAULT_MAX_ATTEMPTS = 5
+
+# use the STS endpoint of the Lambda Region, not the global one
+os.environ.setdefault('AWS_STS_REGIONAL_ENDPOINTS', 'regional')
+
+_lock = threading.Lock()
+_clients = {}
+_client_hooks = []
+_config = None
+
+def register_client_hook(hook):
+    # hook(client, session) is called for every new client, e.g. to
+    # register botocore event handlers on client.meta.events
+    _client_hooks.append(hook)
+
+def get_client_config():
+    global _config
+    if _config is None:
+        from botocore.config import Config
+        _config = Config(
+            max_pool_connections=int(os.environ.get('client_max_pool_connections', DEFAULT_MAX_POOL_CONNECTIONS)),
+            tcp_keepalive=os.environ.get('client_tcp_keepalive', 'yes') == 'yes',
+            retries={
+                'mode': os.environ.get('client_retry_mode', DEFAULT_RETRY_MODE),
+                'max_attempts': int(os.environ.get('client_max_attempts', DEFAULT_MAX_ATTEMPTS))
+            }
+        )
+    return _config
+
+def get_client(session, service, region=None):
+    # boto3 Sessions are not thread safe, clients are: create under the lock,
+    # then share the client between threads
+    key = (id(session), service, region)
+    with _lock:
+        entry = _clients.get(key)
+        if entry is None or entry[0] is not session:
+            client = session.client(service,
+                region_name=region,
+                endpoint_url=os.environ.get('aws_endpoint_url'),
+                config=get_client_config())
+            for hook in _client_hooks:
+                hook(client, session)
+            entry = (session, client)
+            _clients[key] = entry
+    return entry[1]
+
+def clear_clients():
+    with _lock:
+        _clients.clear()
@@ -0,0 +1,101 @@
+import os
+import threading
+import boto3
+from botocore.credentials import RefreshableCredentials
+from botocore.session import get_session
+from sh_clients import get_client
+
+# Shared STS credential provider for the SecurityHub Enabler handlers.
+# Assumed-role sessions are cached per (account, role, external id) for the
+# life of a warm Lambda container. Credentials are refreshed by botocore
+# before they expire, so a cached session can be used by any invocation.
+#
+# Environment Variables
+# assume_role_duration (optional, seconds, default 3600)
+#
+
+DEFAULT_DURATION_SECONDS = 3600
+
+_lock = threading.Lock()
+# one lock per key: the first caller assumes the role, callers for the same
+# key wait for it, other accounts are not held up by its STS call
+_key_locks = {}
+_sessions = {}
+_base_session = None
+_partition = None
+
+def get_base_session():
+    global _base_session
+    if _base_session is None:
+        _base_session = boto3.Session()
+    return _base_session
+
+def get_sts_client():
+    # regional STS endpoint of the Lambda Region
+    return get_client(get_base_session(), 'sts', get_base_session().region_name)
+
+def get_partition():
+    # resolved once per container
+    global _partition
+    if _partition is None:
+        try:
+            _partition = get_base_session().get_partition_for_region(get_base_session().region_name)
+        except Exception:
+            _partition = get_sts_client().get_caller_identity()['Arn'].split(":")[1]
+    return _partition
+
+def role_credentials_fetcher(org_id, aws_account_number, role_name):
+    role_arn = 'arn:%s:iam::%s:role/%s' % (get_partition(), aws_account_number, role_name)
+    duration = int(os.environ.get('assume_role_duration', DEFAULT_DURATION_SECONDS))
+    def fetch():
+        response = get_sts_client().assume_role(
+            RoleArn=role_arn,
+            RoleSessionName=str(aws_account_number+'-'+role_name),
+            ExternalId=org_id,
+            DurationSeconds=duration
+        )
+        credentials = response['Credentials']
+        print(f"Assumed Role: {role_arn} valid until {credentials['Expiration']}")
+        return {
+            'access_key': credentials['AccessKeyId'],
+            'secret_key': credentials['SecretAccessKey'],
+            'token': credentials['SessionToken'],
+            'expiry_time': credentials['Expiration'].isoformat()
+        }
+    return fetch
+
+def get_key_lock(key):
+    with _lock:
+        return _key_locks.setdefault(key, threading.Lock())
+
+def assume_role(org_id, aws_account_number, role_name):
+    key = (aws_account_number, role_name, org_id)
+    with get_key_lock(key):
+        sts_session = _sessions.get(key)
+        if sts_session is None:
+            fetch = role_credentials_fetcher(org_id, aws_account_number, role_name)
+            botocore_session = get_session()
+            botocore_session._credentials = RefreshableCredentials.create_from_metadata(
+                metadata=fetch(),
+                refresh_using=fetch,
+                method='sts-assume-role'
+            )
+            sts_session = boto3.Session(botocore_session=botocore_session)
+            with _lock:
+                _sessions[key] = sts_session
+            print(f"Assumed region_session for Account {aws_account_number}")
+        else:
+            print(f"Reusing region_session for Account {aws_account_number}")
+    return sts_session
+
+def get_session_account(session):
+    # account of a session returned by assume_role, None for any other session
+    # no lock: called from client hooks, list() takes a snapshot
+    for (aws_account_number, role_name, org_id), sts_session in list(_sessions.items()):
+        if sts_session is session:
+            return aws_account_number
+    return None
+
+def clear_sessions():
+    with _lock:
+        _sessions.clear()
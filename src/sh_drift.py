@@ -0,0 +1,80 @@
+import os
+from sh_clients import get_client
+from sh_member_index import ASSOCIATED_STATUSES, get_member_statuses
+from sh_plan import PROCESS_LOCAL_BACKENDS, get_plan_backend
+from sh_standards import reconcile_standards
+from sh_store import get_store
+
+# Drift detection for the scheduled reconciliation sweep.
+# Everything is read in bulk from the Management and Admin accounts, no
+# role is assumed into member accounts:
+#   governed accounts and Regions - one paginated ListStackInstances of the
+#                                   Control Tower baseline StackSet
+#   member state                  - one paginated ListMembers per Region
+#                                   from the Admin account
+# An account drifted in a Region when it is not a member of the Admin
+# there, or its MemberStatus is not Enabled/Associated (never invited,
+# invite not accepted, removed, resigned, deleted).
+# Detection changes nothing; the sweep reconciles the Admin's own standards
+# as a separate fix step (reconcile_admin_standards).
+# The redispatch markers (drift#<account>#<region>) outlive the launcher
+# container only in a shared store, by default the plan store (the
+# SHEnablerPlans table in the template).
+#
+# Environment Variables
+# drift_backend (optional, memory | file | sqlite | dynamodb, default plan_backend)
+# drift_location (optional, file path or table name, default plan_location)
+#
+
+CT_BASELINE_STACKSET = 'AWSControlTowerBP-BASELINE-CONFIG'
+
+# drift reason when the account is not a member at all
+NOT_MEMBER = 'NOT_MEMBER'
+# drift reason when SecurityHub is not enabled on the Admin in the Region
+ADMIN_NOT_ENABLED = 'ADMIN_NOT_ENABLED'
+
+def list_governed_accounts(cf_client):
+    # { account: set(regions) } of every account enrolled in Control Tower
+    governed = {}
+    paginator = cf_client.get_paginator('list_stack_instances')
+    for page in paginator.paginate(StackSetName=CT_BASELINE_STACKSET):
+        for summary in page['Summaries']:
+            governed.setdefault(summary['Account'], set()).add(summary['Region'])
+    return governed
+
+def get_drift_backend():
+    return os.environ.get('drift_backend') or get_plan_backend()
+
+def is_drift_store_shared():
+    return get_drift_backend() not in PROCESS_LOCAL_BACKENDS
+
+def get_drift_store():
+    return get_store(get_drift_backend(), os.environ.get('drift_location') or os.environ.get('plan_location'))
+
+def find_region_drift(sh_admin_session, sh_admin_account, region, accounts):
+    # { account: reason } of the drifted accounts in the Region, reads only
+    sh_admin_client = get_client(sh_admin_session, 'securityhub', region)
+    statuses = get_member_statuses(sh_admin_client)
+    if statuses is None:
+        print('SecurityHub not enabled on Admin: {} in Region: {}'.format(sh_admin_account, region))
+        return { account: ADMIN_NOT_ENABLED for account in accounts }
+    drift = {}
+    for account in accounts:
+        status = statuses.get(account)
+        if status is None:
+            drift[account] = NOT_MEMBER
+        elif status not in ASSOCIATED_STATUSES:
+            drift[account] = status.upper()
+    print('Region: {} has {} of {} accounts drifted'.format(region, len(drift), len(accounts)))
+    return drift
+
+def reconcile_admin_standards(sh_admin_session, sh_admin_account, region, security_standards):
+    # fix step of the sweep, True once the Admin's standards match
+    try:
+        sh_admin_client = get_client(sh_admin_session, 'securityhub', region)
+        reconcile_standards(sh_admin_client, sh_admin_account, region, security_standards)
+        return True
+    except Exception as e:
+        print('Failed to reconcile standards of Admin: {} in Region: {}'.format(sh_admin_account, region))
+        print(str(e))
+        return False
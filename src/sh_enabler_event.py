@@ -1,16 +1,25 @@
 #
 # Environemt Variables
 # event_bus
+# event_mode (optional, account | batch, default account)
+# event_max_attempts (optional, PutEvents attempts for failed entries, default 3)
+#
+# account - one SecurityHubEnabled event per account
+# batch   - SecurityHubEnabledSummary events covering many accounts, each
+#           with the status of every Region, packed up to the PutEvents
+#           entry size; an execution sends a handful of events
+# Entries are sent 10 per PutEvents call within the request size limit and
+# only the entries counted in FailedEntryCount are retried.
 #
 
-import sys
 import boto3
 import json
-import urllib3
 import os
+import time
 import logging
-from datetime import date, datetime
-from botocore.exceptions import ClientError
+from datetime import datetime
+from sh_clients import get_client
+from sh_metrics import metrics_handler
 
 LOGGER = logging.getLogger()
 if 'log_level' in os.environ:
@@ -19,34 +28,64 @@ if 'log_level' in os.environ:
 else:
     LOGGER.setLevel(logging.ERROR)
 
-session = boto3.Session()
+# globals
+session = None
+# PutEvents limits: entries per call, and bytes per entry and per call
+MAX_ENTRIES_PER_CALL = 10
+MAX_REQUEST_SIZE = 256 * 1024
+EVENT_MAX_ATTEMPTS = int(os.environ.get('event_max_attempts', 3))
 
-def json_serial(obj):
-    if isinstance(obj, (datetime, date)):
-        return obj.isoformat()
-    raise TypeError('Type %s not serializable' % type(obj))
+def get_session():
+    # built on first use, not at import
+    global session
+    if session is None:
+        session = boto3.Session()
+    return session
 
-def push_sh_enabled_event(event_source, resource_arn, member_account, member_email):
-    try:
-        ev_client = session.client('events')
-        event_payload = {
-            'EventName': 'SecurityHubEnabled',
-            'Message': 'SecurityHub enabled on Account',
-            'serviceEventDetails': {
-                'securityHubEnabledAccount': {
-                    'member_account': member_account,
-                    'member_email': member_email
-                }
+def build_event(event_source, resource_arn, event_payload):
+    return {
+        'Time': datetime.strftime(datetime.now(), '%Y-%m-%dT%H:%M:%SZ'),
+        'Source': event_source,
+        'Resources': [ resource_arn ],
+        'DetailType': 'SHEnablerSM Event',
+        'Detail': json.dumps(event_payload),
+        'EventBusName': os.environ['event_bus']
+    }
+
+def account_payload(member_account, member_email):
+    return {
+        'EventName': 'SecurityHubEnabled',
+        'Message': 'SecurityHub enabled on Account',
+        'serviceEventDetails': {
+            'securityHubEnabledAccount': {
+                'member_account': member_account,
+                'member_email': member_email
             }
         }
-        event = {
-            'Time': datetime.strftime(datetime.now(), '%Y-%m-%dT%H:%M:%SZ'),
-            'Source': event_source,
-            'Resources': [ resource_arn ],
-            'DetailType': 'SHEnablerSM Event',
-            'Detail': json.dumps(event_payload),
-            'EventBusName': os.environ['event_bus']
+    }
+
+def summary_payload(accounts):
+    return {
+        'EventName': 'SecurityHubEnabledSummary',
+        'Message': 'SecurityHub enabled on Accounts',
+        'serviceEventDetails': {
+            'securityHubEnabledAccounts': accounts
         }
+    }
+
+def entry_size(entry):
+    # PutEvents entry size as EventBridge computes it
+    size = 14 if 'Time' in entry else 0
+    size += len(entry['Source'].encode('utf-8'))
+    size += len(entry['DetailType'].encode('utf-8'))
+    size += len(entry['Detail'].encode('utf-8'))
+    size += sum(len(resource.encode('utf-8')) for resource in entry.get('Resources', []))
+    return size
+
+def push_sh_enabled_event(event_source, resource_arn, member_account, member_email):
+    try:
+        ev_client = get_client(get_session(), 'events')
+        event = build_event(event_source, resource_arn, account_payload(member_account, member_email))
         print('Event:')
         print(json.dumps(event, indent=2))
         response = ev_client.put_events(Entries=[ event ])
@@ -56,12 +95,153 @@ def push_sh_enabled_event(event_source, resource_arn, member_account, member_ema
         print(f'failed in put_events(..): {e}')
         print(str(e))
 
+def pack_summary_events(event_source, resource_arn, accounts, max_size=MAX_REQUEST_SIZE):
+    # as many accounts per summary event as fit in one PutEvents entry
+    empty_size = entry_size(build_event(event_source, resource_arn, summary_payload([])))
+    events = []
+    batch = []
+    size = empty_size
+    for account in accounts:
+        # json.dumps separates list elements with ', '
+        account_size = len(json.dumps(account).encode('utf-8')) + 2
+        if len(batch) > 0 and size + account_size > max_size:
+            events.append(build_event(event_source, resource_arn, summary_payload(batch)))
+            batch = []
+            size = empty_size
+        batch.append(account)
+        size += account_size
+    if len(batch) > 0:
+        events.append(build_event(event_source, resource_arn, summary_payload(batch)))
+    return events
+
+def request_batches(entries):
+    # at most 10 entries and 256 KB per PutEvents call
+    batch = []
+    size = 0
+    for index, entry in enumerate(entries):
+        if len(batch) == MAX_ENTRIES_PER_CALL or (len(batch) > 0 and size + entry_size(entry) > MAX_REQUEST_SIZE):
+            yield batch
+            batch = []
+            size = 0
+        batch.append(index)
+        size += entry_size(entry)
+    if len(batch) > 0:
+        yield batch
+
+def put_entries(entries):
+    # returns one PutEvents result entry per entry, in order; only the
+    # entries counted in FailedEntryCount are sent again
+    ev_client = get_client(get_session(), 'events')
+    results = [None] * len(entries)
+    pending = list(range(len(entries)))
+    for attempt in range(1, EVENT_MAX_ATTEMPTS + 1):
+        failed = []
+        for batch in request_batches([entries[index] for index in pending]):
+            indexes = [pending[position] for position in batch]
+            try:
+                response = ev_client.put_events(Entries=[entries[index] for index in indexes])
+                for index, result in zip(indexes, response['Entries']):
+                    results[index] = result
+                    if 'ErrorCode' in result:
+                        failed.append(index)
+                if response['FailedEntryCount'] > 0:
+                    print('PutEvents attempt {}: {} of {} entries failed'.format(attempt, response['FailedEntryCount'], len(indexes)))
+            except Exception as e:
+                print(f'failed in put_events(..): {e}')
+                for index in indexes:
+                    results[index] = { 'ErrorCode': 'Exception', 'ErrorMessage': str(e) }
+                failed.extend(indexes)
+        pending = failed
+        if len(pending) == 0:
+            break
+        if attempt < EVENT_MAX_ATTEMPTS:
+            time.sleep(0.5 * 2 ** (attempt - 1))
+    return results
+
+def get_region_status(result):
+    # compact Map output: the item failed if any step's delta failed
+    statuses = [step.get('delta', {}).get('status') for step in result.get('results', {}).values()]
+    return 'FAILED' if 'FAILED' in statuses else 'SUCCEEDED'
+
+def aggregate_accounts(event):
+    # Map output (items, or compact deltas) -> one summary per account
+    # with the status of every Region
+    accounts = {}
+    if 'results' in event:
+        items = [
+            {
+                'member_account': result['item'][0],
+                'member_email': event['accounts'][result['item'][0]]['email'],
+                'member_region': result['item'][1],
+                'status': get_region_status(result)
+            } for result in event['results']
+        ]
+    else:
+        # the steps carry a FAILED status forward, the last step's is the item's
+        items = event
+    for item in items:
+        account = accounts.setdefault(item['member_account'], {
+            'member_account': item['member_account'],
+            'member_email': item['member_email'],
+            'status': 'SUCCEEDED',
+            'regions': {}
+        })
+        status = item.get('status', 'SUCCEEDED')
+        account['regions'][item['member_region']] = status
+        if status != 'SUCCEEDED':
+            account['status'] = 'FAILED'
+    return list(accounts.values())
+
+def send_summary_events(event_source, resource_arn, event):
+    accounts = aggregate_accounts(event)
+    entries = pack_summary_events(event_source, resource_arn, accounts)
+    results = put_entries(entries)
+    failed = sum(1 for result in results if 'ErrorCode' in result)
+    print('Sent {} summary events for {} Accounts, {} failed'.format(len(entries) - failed, len(accounts), failed))
+    return {
+        'statusCode': 200,
+        'accounts': len(accounts),
+        'failed_accounts': [account['member_account'] for account in accounts if account['status'] != 'SUCCEEDED'],
+        'events': len(entries),
+        'failed_events': failed,
+        'event_data': results
+    }
+
+@metrics_handler
 def lambda_handler(event, context):
     print(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
-    member_account = event['member_account']
-    member_email = event['member_email']
     event_source = 'org.{}'.format(context.function_name)
     resource_arn = context.invoked_function_arn
+    # batch mode: summary events with per-Region status for the whole Map output
+    if os.environ.get('event_mode') == 'batch' and ('results' in event or isinstance(event, list)):
+        return send_summary_events(event_source, resource_arn, event)
+    # compact Map output: deltas keyed by [account, region], emails from the execution input
+    if 'results' in event:
+        event = [
+            {
+                'member_account': result['item'][0],
+                'member_email': event['accounts'][result['item'][0]]['email']
+            } for result in event['results']
+        ]
+    # Map output of an execution covering many accounts: one event per account
+    if isinstance(event, list):
+        members = {}
+        for item in event:
+            members.setdefault(item['member_account'], item['member_email'])
+        results = put_entries([
+            build_event(event_source, resource_arn, account_payload(member_account, member_email))
+            for member_account, member_email in members.items()
+        ])
+        return [
+            {
+                'statusCode': 200,
+                'member_account': member_account,
+                'member_email': member_email,
+                'event_data': result
+            } for (member_account, member_email), result in zip(members.items(), results)
+        ]
+    member_account = event['member_account']
+    member_email = event['member_email']
     response_data = push_sh_enabled_event(event_source, resource_arn, member_account, member_email)
     return {
         'statusCode': 200,
@@ -0,0 +1,32 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Helpers shared by the handlers to process every item of the
+# region list (as built by sh_sm_launcher.prepare_input) in one invocation.
+#
+# Environment Variables
+# fan_out_max_workers (optional, default 8)
+#
+
+DEFAULT_MAX_WORKERS = 8
+
+def get_max_workers(item_count):
+    limit = int(os.environ.get('fan_out_max_workers', DEFAULT_MAX_WORKERS))
+    return max(1, min(limit, item_count))
+
+def fan_out(items, worker):
+    # run worker(item) for all items on a bounded thread pool
+    # results are returned in the same order as items
+    if len(items) == 0:
+        return []
+    def run(item):
+        try:
+            return worker(item)
+        except Exception as e:
+            print('Failed to process Account: {} in Region: {}'.format(
+                item.get('member_account'), item.get('member_region')
+            ))
+            print(str(e))
+            return dict(item, status='FAILED', error=str(e))
+    with ThreadPoolExecutor(max_workers=get_max_workers(len(items))) as executor:
+        return list(executor.map(run, items))
@@ -0,0 +1,50 @@
+import os
+import threading
+import time
+from botocore.exceptions import ClientError
+from sh_clients import get_client
+
+# SecurityHub hub-state probe.
+# Uses DescribeHub (one cheap read) to find out whether SecurityHub is
+# enabled, and caches the answer per (account, region) for the life of
+# a warm Lambda container, so later map iterations skip the probe.
+#
+# Environment Variables
+# hub_state_ttl (optional, seconds, default 3600)
+#
+
+DEFAULT_TTL_SECONDS = 3600
+
+_lock = threading.Lock()
+_hub_states = {}
+
+def get_ttl():
+    return int(os.environ.get('hub_state_ttl', DEFAULT_TTL_SECONDS))
+
+def get_cached_hub_state(account, region):
+    with _lock:
+        entry = _hub_states.get((account, region))
+    if entry is None or entry[1] < time.time():
+        return None
+    return entry[0]
+
+def set_hub_enabled(account, region, enabled=True):
+    with _lock:
+        _hub_states[(account, region)] = (enabled, time.time() + get_ttl())
+
+def probe_hub(sh_client):
+    try:
+        sh_client.describe_hub()
+        return True
+    except ClientError as e:
+        # DescribeHub fails with InvalidAccessException when not subscribed
+        if e.response['Error']['Code'] == 'InvalidAccessException':
+            return False
+        raise e
+
+def is_hub_enabled(sh_session, account, region):
+    enabled = get_cached_hub_state(account, region)
+    if enabled is None:
+        enabled = probe_hub(get_client(sh_session, 'securityhub', region))
+        set_hub_enabled(account, region, enabled)
+    return enabled
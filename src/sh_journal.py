@@ -0,0 +1,60 @@
+import os
+import time
+from sh_store import get_store
+
+# Checkpoint journal for the SecurityHub Enabler handlers.
+# Records every completed (account, region, step), so a re-run of a failed
+# or repeated execution skips the work that already succeeded instead of
+# calling enable, create_members, invite and accept again. Entries are
+# single-key writes, which every sh_store backend applies atomically.
+# Journal errors never fail a step, the step just runs again.
+#
+# Environment Variables
+# journal_enabled (optional, default yes)
+# journal_backend (optional, memory | file | sqlite | dynamodb, default memory)
+# journal_location (file path or table name, required for file, sqlite and dynamodb)
+# journal_ttl (optional, seconds, default 604800)
+#
+
+DEFAULT_TTL_SECONDS = 7 * 24 * 3600
+
+STEP_ENABLE_MEMBER = 'enable_member'
+STEP_ADD_MEMBER = 'add_member'
+STEP_ACCEPT_INVITE = 'accept_invite'
+
+def get_journal():
+    if os.environ.get('journal_enabled', 'yes') != 'yes':
+        return None
+    return get_store(os.environ.get('journal_backend', 'memory'), os.environ.get('journal_location'))
+
+def journal_key(account, region, step):
+    return 'journal#{}#{}#{}'.format(account, region, step)
+
+def get_checkpoint(account, region, step, sh_admin_account=None):
+    # the recorded outcome, None if the step has to run
+    # a checkpoint for another Admin account does not count
+    journal = get_journal()
+    if journal is None:
+        return None
+    try:
+        checkpoint = journal.get(journal_key(account, region, step))
+    except Exception as e:
+        print('Failed to read journal for Account: {} in Region: {} step: {}'.format(account, region, step))
+        print(str(e))
+        return None
+    if checkpoint is None or checkpoint.get('sh_admin_account') != sh_admin_account:
+        return None
+    print('Journal: {} already done for Account: {} in Region: {}'.format(step, account, region))
+    return checkpoint
+
+def record_checkpoint(account, region, step, sh_admin_account=None, **details):
+    journal = get_journal()
+    if journal is None:
+        return
+    checkpoint = dict(details, sh_admin_account=sh_admin_account, completed_at=int(time.time()))
+    try:
+        journal.put(journal_key(account, region, step), checkpoint,
+            ttl=int(os.environ.get('journal_ttl', DEFAULT_TTL_SECONDS)))
+    except Exception as e:
+        print('Failed to write journal for Account: {} in Region: {} step: {}'.format(account, region, step))
+        print(str(e))
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+#
+# Local multi-account runner for the SecurityHub Enabler.
+# Runs Enable Member, Add Member and Accept Invite (sh_account_pipeline)
+# for every account x Region item outside Step Functions, on a bounded
+# thread pool: at most --workers items at once, --per-account Regions of
+# one account and --per-region accounts in one Region (the Admin account's
+# SecurityHub limits are per Region). Prints progress and throughput while
+# it runs, then a per-item report and the API calls per operation.
+#
+# Items come from a JSON file (the list built by sh_sm_launcher.prepare_input,
+# e.g. sh_enabler_sm_input.json, or a compact document), or are built by
+# prepare_input from --account and --regions with the launcher's environment
+# variables (org_id, sh_admin_account, assume_role, ..).
+#
+# Usage:
+#   python3 src/sh_local_runner.py --input sh_enabler_sm_input.json --workers 16 --per-account 4 --per-region 8
+#   python3 src/sh_local_runner.py --input items.json --endpoint-url http://localhost:4566
+#   python3 src/sh_local_runner.py --input sh_enabler_sm_input.json --fake --latency-ms 30
+# --endpoint-url sends every call to a local AWS stand-in (aws_endpoint_url),
+# --fake runs against the in-process stand-in of bench/fake_aws.py.
+#
+
+import argparse
+import contextlib
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+SRC_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+BENCH_DIRECTORY = os.path.join(SRC_DIRECTORY, '..', 'bench')
+
+DEFAULT_WORKERS = 16
+DEFAULT_PER_ACCOUNT = 4
+DEFAULT_PER_REGION = 8
+DEFAULT_PROGRESS_SECONDS = 5
+
+class Scheduler:
+    # hands an item to the pool only when its account and Region are under
+    # their limits, so no worker thread sits blocked on a busy account
+    def __init__(self, workers, per_account, per_region):
+        self.workers = workers
+        self.per_account = per_account
+        self.per_region = per_region
+        self.condition = threading.Condition()
+        self.accounts = Counter()
+        self.regions = Counter()
+        self.in_flight = 0
+
+    def runnable(self, item):
+        return self.in_flight < self.workers and \
+            self.accounts[item['member_account']] < self.per_account and \
+            self.regions[item['member_region']] < self.per_region
+
+    def run(self, items, worker, on_progress, progress_seconds):
+        pending = deque(items)
+        results = []
+
+        def run_item(item):
+            try:
+                result = worker(item)
+            except Exception as e:
+                result = dict(item, status='FAILED', error=str(e), stages={})
+            with self.condition:
+                self.accounts[item['member_account']] -= 1
+                self.regions[item['member_region']] -= 1
+                self.in_flight -= 1
+                results.append(result)
+                self.condition.notify()
+
+        last_progress = time.time()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            with self.condition:
+                while len(pending) > 0 or self.in_flight > 0:
+                    blocked = deque()
+                    while len(pending) > 0 and self.in_flight < self.workers:
+                        item = pending.popleft()
+                        if not self.runnable(item):
+                            blocked.append(item)
+                            continue
+                        self.accounts[item['member_account']] += 1
+                        self.regions[item['member_region']] += 1
+                        self.in_flight += 1
+                        executor.submit(run_item, item)
+                    # keep the input order for the items that had to wait
+                    blocked.extend(pending)
+                    pending = blocked
+                    self.condition.wait(timeout=progress_seconds)
+                    if time.time() - last_progress >= progress_seconds:
+                        on_progress(len(results), self.in_flight, results)
+                        last_progress = time.time()
+        return results
+
+def load_items(path):
+    # region list (prepare_input shape) or compact document
+    from sh_payload import is_compact, iter_items
+    with (sys.stdin if path == '-' else open(path)) as input_file:
+        document = json.load(input_file)
+    if is_compact(document):
+        return list(iter_items(document))
+    return document
+
+def build_items(accounts, regions):
+    # --account ID=EMAIL[@OU], items built like the launcher builds them
+    import sh_sm_launcher
+    items = []
+    for account in accounts:
+        account_id, email = account.split('=', 1)
+        org_unit_id = ''
+        if '@' in email and email.rsplit('@', 1)[1].startswith('ou-'):
+            email, org_unit_id = email.rsplit('@', 1)
+        member = { 'account_id': account_id, 'email': email, 'org_unit_id': org_unit_id, 'state': 'SUCCEEDED' }
+        items.extend(sh_sm_launcher.prepare_input({}, member, regions))
+    return items
+
+def install_fake(args, items):
+    # in-process AWS stand-in seeded with the accounts of the items
+    sys.path.insert(0, BENCH_DIRECTORY)
+    for name, value in (
+        ('AWS_ACCESS_KEY_ID', 'testing'),
+        ('AWS_SECRET_ACCESS_KEY', 'testing'),
+        ('AWS_DEFAULT_REGION', 'us-east-1'),
+        ('AWS_EC2_METADATA_DISABLED', 'true')
+    ):
+        os.environ.setdefault(name, value)
+    from fake_aws import FakeAws
+    fake = FakeAws(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, throttle_rate=args.throttle_rate, seed=args.seed)
+    fake.install()
+    fake.ct_regions = sorted(set(item['member_region'] for item in items))
+    for item in items:
+        for account_id, email in ((item['member_account'], item['member_email']), (item['sh_admin_account'], '')):
+            if account_id not in fake.accounts:
+                fake.add_account(account_id, email, item.get('org_unit_id', ''))
+    return fake
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def print_progress(out, total, started, done, in_flight, results):
+    elapsed = time.time() - started
+    failed = sum(1 for result in results if result['status'] != 'SUCCEEDED')
+    rate = done / elapsed if elapsed > 0 else 0
+    eta = (total - done) / rate if rate > 0 else 0
+    print('[{:7.1f}s] {}/{} items done, {} running, {} failed, {:.2f} items/s, ETA {:.0f}s'.format(
+        elapsed, done, total, in_flight, failed, rate, eta), file=out, flush=True)
+
+def build_report(results, wall_seconds, metrics):
+    durations = [
+        sum(stage.get('duration_ms', 0) for stage in result.get('stages', {}).values())
+        for result in results
+    ]
+    return {
+        'items': len(results),
+        'succeeded': sum(1 for result in results if result['status'] == 'SUCCEEDED'),
+        'failed': sum(1 for result in results if result['status'] != 'SUCCEEDED'),
+        'accounts': len(set(result['member_account'] for result in results)),
+        'regions': len(set(result['member_region'] for result in results)),
+        'wall_seconds': round(wall_seconds, 3),
+        'items_per_second': round(len(results) / wall_seconds, 2) if wall_seconds > 0 else 0,
+        'item_p50_ms': statistics.median(durations) if len(durations) > 0 else 0,
+        'item_p99_ms': percentile(durations, 0.99) if len(durations) > 0 else 0,
+        'calls': {
+            '{}.{}'.format(service, operation): {
+                'calls': entry['Calls'],
+                'errors': entry['Errors'],
+                'throttles': entry['Throttles']
+            } for (service, operation), entry in sorted(metrics.items())
+        },
+        'results': [
+            {
+                'member_account': result['member_account'],
+                'member_region': result['member_region'],
+                'status': result['status'],
+                'stages': {
+                    name: stage['status'] for name, stage in result.get('stages', {}).items()
+                },
+                'invite_outcome': result.get('stages', {}).get('accept_invite', {}).get('invite_outcome'),
+                'duration_ms': sum(stage.get('duration_ms', 0) for stage in result.get('stages', {}).values()),
+                'error': result.get('error')
+            } for result in sorted(results, key=lambda result: (result['member_account'], result['member_region']))
+        ]
+    }
+
+def print_report(out, report):
+    print(file=out)
+    print('{:<14} {:<16} {:<10} {:<14} {:<14} {:<14} {:>9}'.format(
+        'account', 'region', 'status', 'enable_member', 'add_member', 'accept_invite', 'ms'), file=out)
+    for result in report['results']:
+        stages = result['stages']
+        print('{:<14} {:<16} {:<10} {:<14} {:<14} {:<14} {:>9}'.format(
+            result['member_account'], result['member_region'], result['status'],
+            stages.get('enable_member', '-'), stages.get('add_member', '-'), stages.get('accept_invite', '-'),
+            result['duration_ms']), file=out)
+    print(file=out)
+    print('{:<52} {:>8} {:>8} {:>10}'.format('operation', 'calls', 'errors', 'throttled'), file=out)
+    for operation, counts in report['calls'].items():
+        print('{:<52} {:>8} {:>8} {:>10}'.format(operation, counts['calls'], counts['errors'], counts['throttles']), file=out)
+    print(file=out)
+    print('Items: {} ({} accounts x {} Regions)  Succeeded: {}  Failed: {}'.format(
+        report['items'], report['accounts'], report['regions'], report['succeeded'], report['failed']), file=out)
+    print('Wall time: {}s  Throughput: {} items/s  Item p50: {}ms  p99: {}ms'.format(
+        report['wall_seconds'], report['items_per_second'], report['item_p50_ms'], report['item_p99_ms']), file=out)
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the SecurityHub Enabler for many accounts and Regions locally')
+    parser.add_argument('--input', help='JSON file of items (prepare_input list or compact document), - for stdin')
+    parser.add_argument('--account', action='append', default=[], metavar='ID=EMAIL[@OU]', help='build items with prepare_input')
+    parser.add_argument('--regions', help='comma separated Regions for --account, default the Control Tower Regions')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='items running at once')
+    parser.add_argument('--per-account', type=int, default=DEFAULT_PER_ACCOUNT, help='Regions of one account running at once')
+    parser.add_argument('--per-region', type=int, default=DEFAULT_PER_REGION, help='accounts in one Region running at once')
+    parser.add_argument('--skip-stages', default='', help='comma separated stages to skip, e.g. accept_invite')
+    parser.add_argument('--progress-seconds', type=float, default=DEFAULT_PROGRESS_SECONDS)
+    parser.add_argument('--endpoint-url', help='send every call to a local AWS stand-in')
+    parser.add_argument('--fake', action='store_true', help='run against the in-process stand-in of bench/fake_aws.py')
+    parser.add_argument('--latency-ms', type=float, default=20, help='--fake: latency of every API call')
+    parser.add_argument('--jitter-ms', type=float, default=10, help='--fake: random extra latency per API call')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='--fake: probability that a call is throttled')
+    parser.add_argument('--seed', type=int, default=1, help='--fake: random seed')
+    parser.add_argument('--log', default=os.devnull, help='file for the handlers\' output, default discarded')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+    if not args.input and not args.account:
+        parser.error('one of --input or --account is required')
+    if args.fake and args.account and not args.regions:
+        parser.error('--fake with --account needs --regions')
+
+    if args.endpoint_url:
+        os.environ['aws_endpoint_url'] = args.endpoint_url
+    out = sys.stdout
+    with open(args.log, 'a') as log, contextlib.redirect_stdout(log):
+        if args.input:
+            items = load_items(args.input)
+            if args.fake:
+                install_fake(args, items)
+        else:
+            regions = args.regions.split(',') if args.regions else None
+            if args.fake:
+                # the stand-in has to be there before prepare_input runs
+                install_fake(args, [
+                    {
+                        'member_account': account.split('=', 1)[0],
+                        'member_email': account.split('=', 1)[1],
+                        'member_region': region,
+                        'sh_admin_account': os.environ['sh_admin_account']
+                    } for account in args.account for region in regions
+                ])
+            items = build_items(args.account, regions)
+
+        import sh_account_pipeline
+        from sh_metrics import collect_metrics
+        from sh_member_invite import get_deadline
+        skip_stages = set(stage.strip() for stage in args.skip_stages.split(',') if stage.strip())
+        print('Running {} items on {} workers, {} per account, {} per Region'.format(
+            len(items), args.workers, args.per_account, args.per_region), file=out, flush=True)
+        scheduler = Scheduler(max(1, args.workers), max(1, args.per_account), max(1, args.per_region))
+        started = time.time()
+        results = scheduler.run(
+            items,
+            # polling budget per item, as a fresh Lambda invocation would have
+            lambda item: sh_account_pipeline.run_pipeline(item, skip_stages, get_deadline(None)),
+            lambda done, in_flight, results: print_progress(out, len(items), started, done, in_flight, results),
+            args.progress_seconds
+        )
+        wall_seconds = time.time() - started
+        print_progress(out, len(items), started, len(results), 0, results)
+        report = build_report(results, wall_seconds, collect_metrics())
+
+    if args.json:
+        print(json.dumps(report, indent=2), file=out)
+    else:
+        print_report(out, report)
+    return 0 if report['failed'] == 0 else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,16 @@
-import sys
-import boto3
 import json
-import urllib3
 import os
 import logging
-from datetime import date, datetime
-from botocore.exceptions import ClientError
+from sh_clients import get_client
+from sh_credentials import assume_role
+from sh_fanout import fan_out
+from sh_journal import STEP_ENABLE_MEMBER, get_checkpoint, record_checkpoint
+from sh_metrics import metrics_handler
+from sh_organization import is_organization_mode
+from sh_payload import is_compact, iter_items, to_delta
+from sh_plan import is_planned
+from sh_rate_limit import install_rate_limiter
+from sh_standards import reconcile_standards
 
 LOGGER = logging.getLogger()
 if 'log_level' in os.environ:
@@ -14,124 +19,45 @@ if 'log_level' in os.environ:
 else:
     LOGGER.setLevel(logging.ERROR)
 
-session = boto3.Session()
-
 # globals
+# SecurityHub calls of all threads wait for their (account, region, operation) rate limit
+install_rate_limiter()
 
-def json_serial(obj):
-    if isinstance(obj, (datetime, date)):
-        return obj.isoformat()
-    raise TypeError('Type %s not serializable' % type(obj))
-
-def assume_role(org_id, aws_account_number, role_name):
-    sts_client = boto3.client('sts')
-    partition = sts_client.get_caller_identity()['Arn'].split(":")[1]
-    response = sts_client.assume_role(
-        RoleArn='arn:%s:iam::%s:role/%s' % (
-            partition, aws_account_number, role_name
-        ),
-        RoleSessionName=str(aws_account_number+'-'+role_name),
-        ExternalId=org_id
-    )
-    sts_session = boto3.Session(
-        aws_access_key_id=response['Credentials']['AccessKeyId'],
-        aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-        aws_session_token=response['Credentials']['SessionToken']
-    )
-    print(f"Assumed region_session for Account {aws_account_number}")
-    return sts_session
-
-def enable_security_hub(member_session, member_account, region, security_standards):
+def enable_security_hub(member_session, member_account, region, security_standards, use_journal=True):
+    checkpoint = get_checkpoint(member_account, region, STEP_ENABLE_MEMBER) if use_journal else None
+    if checkpoint is not None and checkpoint.get('security_standards') == security_standards:
+        return True
     try:
-        sh_client = member_session.client('securityhub', 
-        endpoint_url=f"https://securityhub.{region}.amazonaws.com", 
-        region_name=region)
-        sh_client.enable_security_hub()
-        process_security_standards(member_session, member_account, region, security_standards)
+        sh_client = get_client(member_session, 'securityhub', region)
+        try:
+            sh_client.enable_security_hub()
+        except sh_client.exceptions.ResourceConflictException:
+            # already enabled, still reconcile the standards
+            print('SecurityHub is already enabled for Account: {} in Region: {}'.format(member_account, region))
+        if not process_security_standards(member_session, member_account, region, security_standards):
+            # no checkpoint: the next run reconciles the standards again
+            return False
+        record_checkpoint(member_account, region, STEP_ENABLE_MEMBER, security_standards=security_standards)
+        return True
     except Exception as e:
         print('Failed to enable SecurityHub for Account: {} in Region: {}'.format(member_account, region))
         print(str(e))
+        return False
 
 def process_security_standards(sh_session, sh_account, region, security_standards):
+    # True once the standards match security_standards
     try:
-        sh_client = sh_session.client('securityhub', 
-            endpoint_url=f"https://securityhub.{region}.amazonaws.com", 
-            region_name=region)
-        # AWS standard ARNs
-        aws_standard_arn = 'arn:aws:securityhub:{}::standards/aws-foundational-security-best-practices/v/1.0.0'.format(region)
-        aws_subscription_arn = 'arn:aws:securityhub:{}:{}:subscription/aws-foundational-security-best-practices/v/1.0.0'.format(region, sh_account)
-        # CIS standard ARNs
-        cis_standard_arn = 'arn:aws:securityhub:::ruleset/cis-aws-foundations-benchmark/v/1.2.0'
-        cis_subscription_arn = 'arn:aws:securityhub:{}:{}:subscription/cis-aws-foundations-benchmark/v/1.2.0'.format(region, sh_account)
-        aws_standard_enabled = False
-        cis_standard_enabled = False
-        enabled_standards = sh_client.get_enabled_standards()
-        for enabled_standard in enabled_standards['StandardsSubscriptions']:
-            if aws_standard_arn in enabled_standard['StandardsArn']:
-                aws_standard_enabled = True
-            if cis_standard_arn in enabled_standard['StandardsArn']:
-                cis_standard_enabled = True
-        for standard in security_standards:
-            if standard['aws'] == 'yes':
-                if aws_standard_enabled:
-                    print('Standard: {} is already enabled in Account: {} in Region: {}'.format(aws_standard_arn, sh_account, region))
-                else:
-                    try:
-                        response = sh_client.batch_enable_standards(
-                            StandardsSubscriptionRequests=[
-                                {
-                                    'StandardsArn': aws_standard_arn
-                                }
-                            ]
-                        )
-                        print(json.dumps(response))
-                        print('Standard: {} is enabled in Account: {} in Region: {}'.format(aws_standard_arn, sh_account, region))
-                    except Exception as ex:
-                        print('Failed to enable Standard: {} in Account: {} in Region: {}: {}'.format(aws_standard_arn, sh_account, region, ex))
-                        print(str(ex))
-            elif standard['aws'] == 'no':
-                try:
-                    response = sh_client.batch_disable_standards(StandardsSubscriptionArns=[aws_subscription_arn])
-                    print(json.dumps(response))
-                    print('Standard: {} is disabled in Account: {} in Region: {}'.format(aws_standard_arn, sh_account, region))
-                except Exception as ex:
-                    print('Failed to disable Standard: {} in Account: {} in Region: {}: {}'.format(aws_standard_arn, sh_account, region, ex))
-                    print(str(ex))
-            if standard['cis'] == 'yes':
-                if cis_standard_enabled:
-                    print('Standard: {} is already enabled in Account: {} in Region: {}'.format(cis_standard_arn, sh_account, region))
-                else:
-                    try:
-                        response = sh_client.batch_enable_standards(
-                            StandardsSubscriptionRequests=[
-                                {
-                                    'StandardsArn': cis_standard_arn
-                                }
-                            ]
-                        )
-                        print(json.dumps(response))
-                        print('Standard: {} is enabled in Account: {} in Region: {}'.format(cis_standard_arn, sh_account, region))
-                    except Exception as ex:
-                        print('Failed to enable Standard: {} in Account: {} in Region: {}: {}'.format(cis_standard_arn, sh_account, region, ex))
-                        print(str(ex))
-            elif standard['cis'] == 'no':
-                try:
-                    response = sh_client.batch_disable_standards(StandardsSubscriptionArns=[cis_subscription_arn])
-                    print(json.dumps(response))
-                    print('Standard: {} is disabled in Account: {} in Region: {}'.format(cis_standard_arn, sh_account, region))
-                except Exception as ex:
-                    print('Failed to disable Standard: {} in Account: {} in Region: {}: {}'.format(cis_standard_arn, sh_account, region, ex))
-                    print(str(ex))
+        sh_client = get_client(sh_session, 'securityhub', region)
+        reconcile_standards(sh_client, sh_account, region, security_standards)
+        return True
     except Exception as e:
         print(f"Failed to enable security standards: {e}")
         print(str(e))
-    return security_standards
+        return False
 
 def accept_invitation(member_session, member_account, sh_admin_account, region):
     try:
-        sh_client = member_session.client('securityhub', 
-            endpoint_url=f"https://securityhub.{region}.amazonaws.com", 
-            region_name=region)
+        sh_client = get_client(member_session, 'securityhub', region)
         paginator = sh_client.get_paginator('list_invitations')
         iterator = paginator.paginate()
         for page in iterator:
@@ -153,33 +79,67 @@ def accept_invitation(member_session, member_account, sh_admin_account, region):
         print('Member: {} failed to Accept Invitation from Admin: {} in Region: {}'.format(member_account, sh_admin_account, region))
         print(str(e))
 
-def lambda_handler(event, context):
-    print(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
-    org_id = event['org_id']
-    ou_id = event['org_unit_id']
-    ct_home_region = event['ct_home_region']
-    sh_admin_account = event['sh_admin_account']
-    assume_role_name = event['assume_role']
-    compliance_frequency = event['compliance_frequency']
-    enable_aws_standard = event['enable_aws_standard']
-    enable_cis_standard = event['enable_cis_standard']
-    member_account = event['member_account']
-    member_email = event['member_email']
-    member_region = event['member_region']
-    security_standards = [ { 'aws': enable_aws_standard, 'cis': enable_cis_standard } ]
-    member_session = assume_role(org_id, member_account, assume_role_name)
-    enable_security_hub(member_session, member_account, member_region, security_standards)
+def needs_member_session(item):
+    return not is_organization_mode(item) and is_planned(item, STEP_ENABLE_MEMBER)
+
+def process_member_region(member_session, item):
+    member_account = item['member_account']
+    member_region = item['member_region']
+    security_standards = [ { 'aws': item['enable_aws_standard'], 'cis': item['enable_cis_standard'] } ]
+    if is_organization_mode(item):
+        # enabled by organization auto-enable or the Admin's create_members,
+        # Accept Invite enables the accounts the Admin cannot associate
+        print('SecurityHub for Account: {} in Region: {} is enabled by the organization'.format(member_account, member_region))
+        enabled = True
+    elif not is_planned(item, STEP_ENABLE_MEMBER):
+        print('Enable Member for Account: {} in Region: {} is not in plan: {}'.format(member_account, member_region, item['plan_id']))
+        enabled = True
+    else:
+        enabled = enable_security_hub(member_session, member_account, member_region, security_standards,
+            use_journal=not item.get('skip_journal', False))
     return {
         'statusCode': 200,
-        'org_id': org_id,
-        'org_unit_id': ou_id,
-        'ct_home_region': ct_home_region,
-        'sh_admin_account': sh_admin_account,
-        'assume_role': assume_role_name,
-        'compliance_frequency': compliance_frequency,
-        'enable_aws_standard': enable_aws_standard,
-        'enable_cis_standard': enable_cis_standard,
+        'org_id': item['org_id'],
+        'org_unit_id': item['org_unit_id'],
+        'ct_home_region': item['ct_home_region'],
+        'sh_admin_account': item['sh_admin_account'],
+        'assume_role': item['assume_role'],
+        'compliance_frequency': item['compliance_frequency'],
+        'enable_aws_standard': item['enable_aws_standard'],
+        'enable_cis_standard': item['enable_cis_standard'],
         'member_account': member_account,
-        'member_email': member_email,
-        'member_region': member_region        
-    }
\ No newline at end of file
+        'member_email': item['member_email'],
+        'member_region': member_region,
+        'skip_journal': item.get('skip_journal', False),
+        'dispatched_at': item.get('dispatched_at'),
+        'enrolment_mode': item.get('enrolment_mode'),
+        'plan_id': item.get('plan_id'),
+        'status': 'SUCCEEDED' if enabled else 'FAILED'
+    }
+
+def fan_out_regions(items):
+    # one assume_role per member account, then all regions at once
+    member_sessions = {}
+    for item in items:
+        member_account = item['member_account']
+        if member_account not in member_sessions and needs_member_session(item):
+            member_sessions[member_account] = assume_role(item['org_id'], member_account, item['assume_role'])
+    def worker(item):
+        member_session = member_sessions.get(item['member_account'])
+        return process_member_region(member_session, item)
+    return fan_out(items, worker)
+
+@metrics_handler
+def lambda_handler(event, context):
+    print(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
+    # compact mode: expand the item(s) lazily, return only the deltas
+    if is_compact(event):
+        deltas = [to_delta(result) for result in fan_out_regions(list(iter_items(event)))]
+        return deltas[0] if 'item' in event else { 'results': deltas }
+    # fan-out mode: event is the whole region list built by sh_sm_launcher.prepare_input
+    if isinstance(event, list):
+        return fan_out_regions(event)
+    member_session = None
+    if needs_member_session(event):
+        member_session = assume_role(event['org_id'], event['member_account'], event['assume_role'])
+    return process_member_region(member_session, event)
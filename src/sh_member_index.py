@@ -0,0 +1,97 @@
+import os
+import threading
+import time
+from botocore.exceptions import ClientError
+from sh_clients import get_client
+
+# Admin-side member status index.
+# One paginated ListMembers per (Admin account, region) gives the
+# MemberStatus of every member; the index is kept in the warm container
+# for member_index_ttl seconds (about one execution) and updated by the
+# writes made through it, so create_members, invite_members and the
+# accept step run only for the accounts whose status requires them.
+# Drift fixes (skip_journal) need a view newer than the sweep that found
+# the drift: the index is rebuilt once if it was built before the execution
+# was dispatched (dispatched_at), not once per item.
+#
+# Environment Variables
+# member_index_ttl (optional, seconds, default 300)
+#
+
+DEFAULT_TTL_SECONDS = 300
+
+ASSOCIATED_STATUSES = ('Enabled', 'Associated')
+# no member record, create_members first
+CREATE_STATUSES = (None, 'Deleted')
+# member record without a pending invitation, invite_members
+INVITE_STATUSES = (None, 'Deleted', 'Created', 'Removed', 'Resigned')
+
+_lock = threading.Lock()
+_key_locks = {}
+_indexes = {}
+
+def get_member_statuses(sh_admin_client):
+    # { account: MemberStatus } of all members, associated or not
+    # None when SecurityHub is not enabled on the Admin in the Region
+    statuses = {}
+    try:
+        paginator = sh_admin_client.get_paginator('list_members')
+        for page in paginator.paginate(OnlyAssociated=False):
+            for member in page['Members']:
+                statuses[member['AccountId']] = member['MemberStatus']
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'InvalidAccessException':
+            return None
+        raise
+    return statuses
+
+def get_key_lock(key):
+    with _lock:
+        return _key_locks.setdefault(key, threading.Lock())
+
+def get_fresh_after(item):
+    # time the index has to be newer than, None when any index will do
+    if not item.get('skip_journal', False):
+        return None
+    # without dispatched_at every item rebuilds it
+    return item.get('dispatched_at') or time.time()
+
+def get_member_index(sh_admin_session, sh_admin_account, region, fresh_after=None):
+    # built once per (Admin account, region), concurrent callers wait for it
+    # rebuilt when older than fresh_after, e.g. for the drift the cached view may have missed
+    key = (sh_admin_account, region)
+    ttl = int(os.environ.get('member_index_ttl', DEFAULT_TTL_SECONDS))
+    with get_key_lock(key):
+        index = _indexes.get(key)
+        if index is None or index['built_at'] + ttl < time.time() or \
+            (fresh_after is not None and index['built_at'] < fresh_after):
+            sh_admin_client = get_client(sh_admin_session, 'securityhub', region)
+            statuses = get_member_statuses(sh_admin_client)
+            index = { 'statuses': statuses or {}, 'built_at': time.time() }
+            if statuses is not None:
+                _indexes[key] = index
+            print('Member index of Admin: {} in Region: {} has {} members'.format(sh_admin_account, region, len(index['statuses'])))
+        return index['statuses']
+
+def get_member_status(sh_admin_session, sh_admin_account, region, member_account, fresh_after=None):
+    # MemberStatus of the account, None if it is not a member
+    return get_member_index(sh_admin_session, sh_admin_account, region, fresh_after).get(member_account)
+
+def set_member_status(sh_admin_account, region, member_account, status):
+    # keep the index in line with the writes made through it
+    with get_key_lock((sh_admin_account, region)):
+        index = _indexes.get((sh_admin_account, region))
+        if index is not None:
+            index['statuses'][member_account] = status
+
+def seed_member_index(sh_admin_account, region, statuses):
+    # a complete ListMembers snapshot read elsewhere (e.g. by a plan)
+    # stands in for the sweep, unless the container already has an index
+    key = (sh_admin_account, region)
+    with get_key_lock(key):
+        if key not in _indexes:
+            _indexes[key] = { 'statuses': dict(statuses), 'built_at': time.time() }
+
+def clear_member_indexes():
+    with _lock:
+        _indexes.clear()
@@ -1,11 +1,19 @@
-import sys
-import boto3
 import json
-import urllib3
 import os
+import random
+import time
 import logging
-from datetime import date, datetime
-from botocore.exceptions import ClientError
+from sh_clients import get_client
+from sh_credentials import assume_role
+from sh_fanout import fan_out
+from sh_journal import STEP_ACCEPT_INVITE, get_checkpoint, record_checkpoint
+from sh_member_index import ASSOCIATED_STATUSES
+from sh_metrics import metrics_handler
+from sh_organization import is_organization_mode
+from sh_payload import is_compact, iter_items, to_delta
+from sh_plan import is_planned
+from sh_rate_limit import install_rate_limiter
+import sh_member_enabler
 
 LOGGER = logging.getLogger()
 if 'log_level' in os.environ:
@@ -14,92 +22,182 @@ if 'log_level' in os.environ:
 else:
     LOGGER.setLevel(logging.ERROR)
 
-session = boto3.Session()
-
 # globals
+# SecurityHub calls of all threads wait for their (account, region, operation) rate limit
+install_rate_limiter()
+# accept_invitation outcomes
+OUTCOME_ACCEPTED = 'ACCEPTED'
+OUTCOME_ALREADY_ASSOCIATED = 'ALREADY_ASSOCIATED'
+OUTCOME_NOT_FOUND = 'NOT_FOUND'
+OUTCOME_FAILED = 'FAILED'
 
-def json_serial(obj):
-    if isinstance(obj, (datetime, date)):
-        return obj.isoformat()
-    raise TypeError('Type %s not serializable' % type(obj))
+# invitation polling
+DEFAULT_POLL_BUDGET_SECONDS = 300
+DEFAULT_POLL_MARGIN_SECONDS = 10
+POLL_INITIAL_DELAY_SECONDS = 1
+POLL_BACKOFF_RATE = 1.5
+POLL_MAX_DELAY_SECONDS = 20
 
-def assume_role(org_id, aws_account_number, role_name):
-    sts_client = boto3.client('sts')
-    partition = sts_client.get_caller_identity()['Arn'].split(":")[1]
-    response = sts_client.assume_role(
-        RoleArn='arn:%s:iam::%s:role/%s' % (
-            partition, aws_account_number, role_name
-        ),
-        RoleSessionName=str(aws_account_number+'-'+role_name),
-        ExternalId=org_id
-    )
-    sts_session = boto3.Session(
-        aws_access_key_id=response['Credentials']['AccessKeyId'],
-        aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-        aws_session_token=response['Credentials']['SessionToken']
-    )
-    print(f"Assumed region_session for Account {aws_account_number}")
-    return sts_session
+def get_deadline(context):
+    # polling budget: what is left of the Lambda timeout, less a safety margin
+    budget = float(os.environ.get('invite_poll_budget', DEFAULT_POLL_BUDGET_SECONDS))
+    if context is not None:
+        remaining = context.get_remaining_time_in_millis() / 1000.0
+        budget = min(budget, remaining - float(os.environ.get('invite_poll_margin', DEFAULT_POLL_MARGIN_SECONDS)))
+    return time.time() + max(budget, 0)
 
-def accept_invitation(member_session, member_account, sh_admin_account, region):
+def is_associated(sh_client, sh_admin_account):
     try:
-        sh_client = member_session.client('securityhub', 
-            endpoint_url=f"https://securityhub.{region}.amazonaws.com", 
-            region_name=region)
-        response = sh_client.list_invitations()
-        for invite in response['Invitations']:
+        response = sh_client.get_administrator_account()
+    except Exception as e:
+        print(str(e))
+        return False
+    administrator = response.get('Administrator', {})
+    return administrator.get('AccountId') == sh_admin_account and \
+        administrator.get('MemberStatus') in ('Associated', 'Enabled')
+
+def find_invitation(sh_client, sh_admin_account):
+    paginator = sh_client.get_paginator('list_invitations')
+    for page in paginator.paginate():
+        for invite in page['Invitations']:
             if invite['AccountId'] == sh_admin_account:
-                invitationId = invite['InvitationId']
-                try:
-                    sh_client.accept_administrator_invitation(
-                        AdministratorId=sh_admin_account,
-                        InvitationId=invitationId
-                    )
-                    print('Member: {} accepted Invite from Admin: {} in Region: {}'.format(
-                        member_account, sh_admin_account, region
-                    ))
-                except Exception as ex:
-                    print('Member: {} could not accept Invite from Admin: {} in Region: {}'.format(
-                        member_account, sh_admin_account, region
-                    ))
-                    print(str(ex))
-            else:
-                print('Invitation from Admin: {} for Member: {} NOT FOUND in Region: {} !'.format(
-                    sh_admin_account, member_account, region
+                return invite['InvitationId']
+    return None
+
+def accept_invitation(member_session, member_account, sh_admin_account, region, deadline=None, use_journal=True):
+    # returns one of the OUTCOME_* values, journaled once associated
+    if use_journal and get_checkpoint(member_account, region, STEP_ACCEPT_INVITE, sh_admin_account) is not None:
+        return OUTCOME_ALREADY_ASSOCIATED
+    outcome = poll_and_accept_invitation(member_session, member_account, sh_admin_account, region, deadline)
+    if outcome in (OUTCOME_ACCEPTED, OUTCOME_ALREADY_ASSOCIATED):
+        record_checkpoint(member_account, region, STEP_ACCEPT_INVITE, sh_admin_account, invite_outcome=outcome)
+    return outcome
+
+def poll_and_accept_invitation(member_session, member_account, sh_admin_account, region, deadline=None):
+    # polls with adaptive backoff until the invite from the Admin has
+    # propagated, then accepts it; returns one of the OUTCOME_* values
+    if deadline is None:
+        deadline = get_deadline(None)
+    try:
+        sh_client = get_client(member_session, 'securityhub', region)
+        if is_associated(sh_client, sh_admin_account):
+            print('Member: {} is already associated with Admin: {} in Region: {}'.format(
+                member_account, sh_admin_account, region
+            ))
+            return OUTCOME_ALREADY_ASSOCIATED
+        delay = POLL_INITIAL_DELAY_SECONDS
+        attempts = 0
+        while True:
+            attempts += 1
+            invitationId = find_invitation(sh_client, sh_admin_account)
+            if invitationId is not None:
+                break
+            if time.time() + delay > deadline:
+                print('Invitation from Admin: {} for Member: {} NOT FOUND in Region: {} after {} attempts !'.format(
+                    sh_admin_account, member_account, region, attempts
                 ))
+                return OUTCOME_NOT_FOUND
+            time.sleep(delay * random.uniform(0.5, 1.0))
+            delay = min(delay * POLL_BACKOFF_RATE, POLL_MAX_DELAY_SECONDS)
+        try:
+            sh_client.accept_administrator_invitation(
+                AdministratorId=sh_admin_account,
+                InvitationId=invitationId
+            )
+            print('Member: {} accepted Invite from Admin: {} in Region: {} after {} attempts'.format(
+                member_account, sh_admin_account, region, attempts
+            ))
+            return OUTCOME_ACCEPTED
+        except Exception as ex:
+            print('Member: {} could not accept Invite from Admin: {} in Region: {}'.format(
+                member_account, sh_admin_account, region
+            ))
+            print(str(ex))
+            return OUTCOME_FAILED
     except Exception as e:
         print('Member: {} failed to Accept Invitation from Admin: {} in Region: {}'.format(
             member_account, sh_admin_account, region
         ))
         print(str(e))
+        return OUTCOME_FAILED
 
-def lambda_handler(event, context):
-    print(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
-    org_id = event['org_id']
-    ou_id = event['org_unit_id']
-    ct_home_region = event['ct_home_region']
-    sh_admin_account = event['sh_admin_account']
-    assume_role_name = event['assume_role']
-    compliance_frequency = event['compliance_frequency']
-    enable_aws_standard = event['enable_aws_standard']
-    enable_cis_standard = event['enable_cis_standard']
-    member_account = event['member_account']
-    member_email = event['member_email']
-    member_region = event['member_region']
-    security_standards = [ { 'aws': enable_aws_standard, 'cis': enable_cis_standard } ]
-    member_session = assume_role(org_id, member_account, assume_role_name)
-    accept_invitation(member_session, member_account, sh_admin_account, member_region)
+def needs_member_session(item):
+    # associated members (e.g. organization accounts) have nothing to accept,
+    # neither have the items a plan left without Accept Invite
+    return item.get('member_status') not in ASSOCIATED_STATUSES and is_planned(item, STEP_ACCEPT_INVITE)
+
+def enable_organization_fallback(member_session, item):
+    # organization mode skips Enable Member, but an account the Admin could not
+    # associate (e.g. outside the organization) takes the invite path and
+    # needs its own hub first
+    member_account = item['member_account']
+    member_region = item['member_region']
+    print('Account: {} is not associated by the organization in Region: {}, enable SecurityHub for the invite'.format(
+        member_account, member_region
+    ))
+    security_standards = [ { 'aws': item['enable_aws_standard'], 'cis': item['enable_cis_standard'] } ]
+    return sh_member_enabler.enable_security_hub(member_session, member_account, member_region, security_standards,
+        use_journal=not item.get('skip_journal', False))
+
+def process_member_region(member_session, item, deadline=None):
+    member_account = item['member_account']
+    sh_admin_account = item['sh_admin_account']
+    member_region = item['member_region']
+    if not needs_member_session(item):
+        # the Admin's member index already has it associated
+        print('Account: {} already associated to Admin: {} in Region: {}'.format(member_account, sh_admin_account, member_region))
+        outcome = OUTCOME_ALREADY_ASSOCIATED
+    elif is_organization_mode(item) and not enable_organization_fallback(member_session, item):
+        outcome = OUTCOME_FAILED
+    else:
+        outcome = accept_invitation(member_session, member_account, sh_admin_account, member_region, deadline,
+            use_journal=not item.get('skip_journal', False))
     return {
         'statusCode': 200,
-        'org_id': org_id,
-        'org_unit_id': ou_id,
-        'ct_home_region': ct_home_region,
+        'org_id': item['org_id'],
+        'org_unit_id': item['org_unit_id'],
+        'ct_home_region': item['ct_home_region'],
         'sh_admin_account': sh_admin_account,
-        'assume_role': assume_role_name,
-        'compliance_frequency': compliance_frequency,
-        'enable_aws_standard': enable_aws_standard,
-        'enable_cis_standard': enable_cis_standard,
+        'assume_role': item['assume_role'],
+        'compliance_frequency': item['compliance_frequency'],
+        'enable_aws_standard': item['enable_aws_standard'],
+        'enable_cis_standard': item['enable_cis_standard'],
         'member_account': member_account,
-        'member_email': member_email,
-        'member_region': member_region
-    }
\ No newline at end of file
+        'member_email': item['member_email'],
+        'member_region': member_region,
+        'skip_journal': item.get('skip_journal', False),
+        'dispatched_at': item.get('dispatched_at'),
+        'enrolment_mode': item.get('enrolment_mode'),
+        'plan_id': item.get('plan_id'),
+        'invite_outcome': outcome,
+        # a failed Enable Member or Add Member stays failed
+        'status': 'FAILED' if item.get('status') == 'FAILED' or outcome not in (OUTCOME_ACCEPTED, OUTCOME_ALREADY_ASSOCIATED) else 'SUCCEEDED'
+    }
+
+def fan_out_regions(items, deadline):
+    # one assume_role per member account, then all regions at once
+    member_sessions = {}
+    for item in items:
+        member_account = item['member_account']
+        if member_account not in member_sessions and needs_member_session(item):
+            member_sessions[member_account] = assume_role(item['org_id'], member_account, item['assume_role'])
+    def worker(item):
+        member_session = member_sessions.get(item['member_account'])
+        return process_member_region(member_session, item, deadline)
+    return fan_out(items, worker)
+
+@metrics_handler
+def lambda_handler(event, context):
+    print(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
+    deadline = get_deadline(context)
+    # compact mode: expand the item(s) lazily, return only the deltas
+    if is_compact(event):
+        deltas = [to_delta(result) for result in fan_out_regions(list(iter_items(event)), deadline)]
+        return deltas[0] if 'item' in event else { 'results': deltas }
+    # fan-out mode: event is the whole region list built by sh_sm_launcher.prepare_input
+    if isinstance(event, list):
+        return fan_out_regions(event, deadline)
+    member_session = None
+    if needs_member_session(event):
+        member_session = assume_role(event['org_id'], event['member_account'], event['assume_role'])
+    return process_member_region(member_session, event, deadline)
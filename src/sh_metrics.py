@@ -0,0 +1,155 @@
+import functools
+import json
+import os
+import time
+from sh_clients import register_client_hook
+
+# Per-call AWS API instrumentation for the SecurityHub Enabler handlers.
+# Hooks into the botocore events of every client built by sh_clients.get_client
+# (including the clients of the assume_role sessions) and records per
+# (service, operation) call count, latency, retries, throttles and errors.
+# A call only appends a tuple to a list; aggregation happens once, when
+# the handler returns and the metrics are printed as CloudWatch Embedded
+# Metric Format (EMF) lines, which CloudWatch Logs turns into metrics.
+#
+# Environment Variables
+# metrics_enabled (optional, default yes)
+# metrics_namespace (optional, default SecurityHubEnabler)
+#
+
+DEFAULT_NAMESPACE = 'SecurityHubEnabler'
+# EMF accepts at most 100 values per metric in one document
+MAX_VALUES_PER_DOCUMENT = 100
+
+THROTTLE_CODES = (
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+    'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded',
+    'SlowDown',
+    'LimitExceededException'
+)
+
+METRICS = [
+    { 'Name': 'Calls', 'Unit': 'Count' },
+    { 'Name': 'Errors', 'Unit': 'Count' },
+    { 'Name': 'Retries', 'Unit': 'Count' },
+    { 'Name': 'Throttles', 'Unit': 'Count' },
+    { 'Name': 'Latency', 'Unit': 'Milliseconds' }
+]
+
+# list.append is atomic, so the fan-out threads record without a lock
+# (service, operation, latency_ms, retries, error)
+_calls = []
+# (service, operation) of every throttled attempt, retried or not
+_throttles = []
+
+def get_error_code(parsed):
+    if not isinstance(parsed, dict):
+        return None
+    return parsed.get('Error', {}).get('Code')
+
+def before_call(model, context, **kwargs):
+    # after before-parameter-build, where the rate limiter waits for its
+    # token, so Latency is the call itself (retries included)
+    context['sh_metrics_started'] = time.perf_counter()
+
+def after_call(model, context, parsed, http_response, **kwargs):
+    started = context.get('sh_metrics_started')
+    if started is None:
+        return
+    _calls.append((
+        model.service_model.service_name,
+        model.name,
+        (time.perf_counter() - started) * 1000,
+        parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0),
+        http_response.status_code >= 300
+    ))
+
+def after_call_error(model, context, exception, **kwargs):
+    # the request never got a response, e.g. connection errors
+    started = context.get('sh_metrics_started')
+    if started is None:
+        return
+    _calls.append((model.service_model.service_name, model.name, (time.perf_counter() - started) * 1000, 0, True))
+
+def needs_retry(response, operation, **kwargs):
+    # emitted for every attempt, before the retry handler decides
+    if response is not None and get_error_code(response[1]) in THROTTLE_CODES:
+        _throttles.append((operation.service_model.service_name, operation.name))
+
+def attach(client, session):
+    events = client.meta.events
+    # first: a before-call handler that returns a response (e.g. a local
+    # stand-in) stops the handlers after it
+    events.register_first('before-call', before_call, unique_id='sh-metrics-before-call')
+    events.register('after-call', after_call, unique_id='sh-metrics-after-call')
+    events.register('after-call-error', after_call_error, unique_id='sh-metrics-after-call-error')
+    events.register('needs-retry', needs_retry, unique_id='sh-metrics-needs-retry')
+
+def collect_metrics():
+    # swap the recorded calls out and aggregate them per (service, operation)
+    global _calls, _throttles
+    calls, throttles = _calls, _throttles
+    _calls, _throttles = [], []
+    metrics = {}
+    for service, operation, latency, retries, error in calls:
+        entry = metrics.setdefault((service, operation), { 'Calls': 0, 'Errors': 0, 'Retries': 0, 'Throttles': 0, 'Latency': [] })
+        entry['Calls'] += 1
+        entry['Errors'] += 1 if error else 0
+        entry['Retries'] += retries
+        entry['Latency'].append(round(latency, 3))
+    for key in throttles:
+        if key in metrics:
+            metrics[key]['Throttles'] += 1
+    return metrics
+
+def format_metrics(function_name, metrics):
+    # one EMF document per operation, more if it has over 100 latency samples
+    namespace = os.environ.get('metrics_namespace', DEFAULT_NAMESPACE)
+    timestamp = int(time.time() * 1000)
+    documents = []
+    for (service, operation), entry in sorted(metrics.items()):
+        latencies = entry['Latency']
+        for start in range(0, len(latencies), MAX_VALUES_PER_DOCUMENT):
+            document = {
+                '_aws': {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': namespace,
+                        'Dimensions': [[ 'FunctionName', 'Service', 'Operation' ]],
+                        'Metrics': METRICS if start == 0 else METRICS[-1:]
+                    }]
+                },
+                'FunctionName': function_name,
+                'Service': service,
+                'Operation': operation,
+                'Latency': latencies[start:start + MAX_VALUES_PER_DOCUMENT]
+            }
+            if start == 0:
+                document.update(Calls=entry['Calls'], Errors=entry['Errors'], Retries=entry['Retries'], Throttles=entry['Throttles'])
+            documents.append(json.dumps(document))
+    return documents
+
+def flush_metrics(function_name):
+    for document in format_metrics(function_name, collect_metrics()):
+        print(document)
+
+def metrics_handler(handler):
+    # decorate a lambda_handler to print the metrics of the invocation
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        try:
+            return handler(event, context)
+        finally:
+            try:
+                flush_metrics(getattr(context, 'function_name', 'local'))
+            except Exception as e:
+                print('Failed to emit metrics: {}'.format(e))
+    return wrapper
+
+if os.environ.get('metrics_enabled', 'yes') == 'yes':
+    register_client_hook(attach)
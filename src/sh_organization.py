@@ -0,0 +1,105 @@
+import os
+from sh_clients import get_client
+from sh_store import get_store
+
+# Organization enrolment mode.
+# Once per Region the Management account designates sh_admin_account as
+# the SecurityHub delegated administrator (EnableOrganizationAdminAccount)
+# and the Admin account turns on organization auto-enable and standards
+# auto-enable (UpdateOrganizationConfiguration). From then on:
+#   new accounts of the organization are enrolled by SecurityHub itself
+#   existing accounts take one CreateMembers from the Admin account, which
+#   associates organization accounts without invitation
+# so no role is assumed into member accounts. Accounts outside the
+# organization stay Created after CreateMembers and take the invite path;
+# Accept Invite enables their hub first, Enable Member skipped it.
+# The per-Region setup is marked done in the region cache store.
+# Standards auto-enable turns on both default standards or none, and Enable
+# Member (which reconciles standards) does not run in organization mode, so
+# a Region only takes organization mode when both standard flags agree;
+# otherwise it falls back to invitations.
+#
+# Environment Variables
+# enrolment_mode (optional, invite | organization, default invite)
+#
+
+ENROLMENT_INVITE = 'invite'
+ENROLMENT_ORGANIZATION = 'organization'
+
+# (Admin account, region, auto-enable standards) set up by this container, skips the store read
+_ready = set()
+
+def get_enrolment_mode():
+    return os.environ.get('enrolment_mode', ENROLMENT_INVITE)
+
+def is_organization_mode(item):
+    return item.get('enrolment_mode') == ENROLMENT_ORGANIZATION
+
+def get_auto_enable_standards(security_standards):
+    # standards auto-enable only knows the default set (FSBP and CIS 1.2),
+    # None when the flags differ and it cannot express them
+    enabled = set(value == 'yes' for standard in security_standards for value in standard.values())
+    if enabled == { True }:
+        return 'DEFAULT'
+    if enabled == { False }:
+        return 'NONE'
+    return None
+
+def enable_organization_admin(mgmt_session, sh_admin_account, region):
+    # Management account side, idempotent
+    sh_mgmt_client = get_client(mgmt_session, 'securityhub', region)
+    admin_accounts = sh_mgmt_client.list_organization_admin_accounts()['AdminAccounts']
+    for admin_account in admin_accounts:
+        if admin_account['AccountId'] == sh_admin_account and admin_account['Status'] == 'ENABLED':
+            print('Account: {} is already SecurityHub delegated administrator in Region: {}'.format(sh_admin_account, region))
+            return False
+    sh_mgmt_client.enable_organization_admin_account(AdminAccountId=sh_admin_account)
+    print('Designated Account: {} as SecurityHub delegated administrator in Region: {}'.format(sh_admin_account, region))
+    return True
+
+def enable_organization_auto_enable(sh_admin_session, sh_admin_account, region, security_standards):
+    # Admin account side, idempotent
+    sh_admin_client = get_client(sh_admin_session, 'securityhub', region)
+    auto_enable_standards = get_auto_enable_standards(security_standards)
+    configuration = sh_admin_client.describe_organization_configuration()
+    if configuration.get('AutoEnable') and configuration.get('AutoEnableStandards') == auto_enable_standards:
+        print('Organization auto-enable already on for Admin: {} in Region: {}'.format(sh_admin_account, region))
+        return False
+    sh_admin_client.update_organization_configuration(AutoEnable=True, AutoEnableStandards=auto_enable_standards)
+    print('Organization auto-enable turned on for Admin: {} in Region: {} with standards: {}'.format(
+        sh_admin_account, region, auto_enable_standards))
+    return True
+
+def setup_organization_region(mgmt_session, get_admin_session, sh_admin_account, region, security_standards):
+    # get_admin_session is only called when the Region still needs the setup
+    auto_enable_standards = get_auto_enable_standards(security_standards)
+    if auto_enable_standards is None:
+        print('Standards: {} cannot be auto-enabled, Region: {} falls back to invitations'.format(security_standards, region))
+        return False
+    # the marker holds the standards, changed flags set the Region up again
+    if (sh_admin_account, region, auto_enable_standards) in _ready:
+        return True
+    store = get_store()
+    marker = 'org_admin#{}#{}#{}'.format(sh_admin_account, region, auto_enable_standards)
+    if store.get(marker) is not None:
+        _ready.add((sh_admin_account, region, auto_enable_standards))
+        return True
+    try:
+        enable_organization_admin(mgmt_session, sh_admin_account, region)
+        enable_organization_auto_enable(get_admin_session(), sh_admin_account, region, security_standards)
+        store.put(marker, True)
+        _ready.add((sh_admin_account, region, auto_enable_standards))
+        return True
+    except Exception as e:
+        print('Failed to set up organization mode for Admin: {} in Region: {}'.format(sh_admin_account, region))
+        print(str(e))
+        return False
+
+def get_org_member_statuses(sh_admin_client, member_accounts):
+    # { account: MemberStatus } right after CreateMembers, organization
+    # accounts are Enabled, accounts outside the organization Created
+    statuses = {}
+    response = sh_admin_client.get_members(AccountIds=member_accounts)
+    for member in response['Members']:
+        statuses[member['AccountId']] = member['MemberStatus']
+    return statuses
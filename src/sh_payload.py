@@ -0,0 +1,103 @@
+# Compact execution input for the SecurityHub Enabler StateMachine.
+#
+# The region list built by sh_sm_launcher.prepare_input repeats every
+# shared field in every item. The compact document keeps them once:
+#   {
+#     "format": "compact-1",
+#     "header": { "org_id": .., "sh_admin_account": .., ..,
+#                 "regions": { "<region>": { "enrolment_mode": .. } } },
+#     "accounts": { "<account>": { "email": .., "org_unit_id": .. } },
+#     "items": [ [ "<account>", "<region>" ], .. ]
+#   }
+# A Map iteration receives { "header", "accounts", "item" } and the handlers
+# return only what they add to the item (the delta), keyed by "item".
+# The StateMachine keeps the deltas under "results"; the fields a later
+# step reads (PASSED_FIELDS) are merged back into the item.
+
+COMPACT_FORMAT = 'compact-1'
+
+HEADER_FIELDS = [
+    'org_id',
+    'ct_home_region',
+    'sh_admin_account',
+    'assume_role',
+    'compliance_frequency',
+    'enable_aws_standard',
+    'enable_cis_standard',
+    'skip_journal',
+    'dispatched_at',
+    'plan_id'
+]
+
+# fields set per Region, e.g. a Region whose organization setup failed
+# falls back to invitations, kept once per Region under header.regions
+REGION_FIELDS = [
+    'enrolment_mode'
+]
+
+ITEM_FIELDS = HEADER_FIELDS + REGION_FIELDS + [
+    'org_unit_id',
+    'member_account',
+    'member_email',
+    'member_region'
+]
+
+# delta fields handed on to the next steps of the same item
+PASSED_FIELDS = [
+    'member_status'
+]
+
+def is_compact(event):
+    return isinstance(event, dict) and 'header' in event and ('item' in event or 'items' in event)
+
+def compact_input(items):
+    # region list (prepare_input shape) -> compact document
+    document = {
+        'format': COMPACT_FORMAT,
+        'header': {},
+        'accounts': {},
+        'items': []
+    }
+    for item in items:
+        if len(document['header']) == 0:
+            document['header'] = { field: item.get(field) for field in HEADER_FIELDS }
+            document['header']['regions'] = {}
+        document['header']['regions'][item['member_region']] = { field: item.get(field) for field in REGION_FIELDS }
+        document['accounts'][item['member_account']] = {
+            'email': item['member_email'],
+            'org_unit_id': item['org_unit_id']
+        }
+        document['items'].append([item['member_account'], item['member_region']])
+    return document
+
+def expand_item(document, item):
+    member_account, member_region = item
+    account = document['accounts'][member_account]
+    header = document['header']
+    expanded = { field: value for field, value in header.items() if field != 'regions' }
+    expanded.update(header.get('regions', {}).get(member_region, {}))
+    return dict(expanded,
+        org_unit_id=account['org_unit_id'],
+        member_account=member_account,
+        member_email=account['email'],
+        member_region=member_region)
+
+def iter_items(document):
+    # expands lazily, one item at a time
+    if 'item' in document:
+        item = expand_item(document, document['item'])
+        for result in document.get('results', {}).values():
+            delta = result.get('delta', {}) if isinstance(result, dict) else {}
+            item.update({ field: delta[field] for field in PASSED_FIELDS if field in delta })
+        yield item
+    else:
+        for item in document['items']:
+            yield expand_item(document, item)
+
+def to_delta(result):
+    delta = {
+        key: value for key, value in result.items()
+        if key not in ITEM_FIELDS and key != 'statusCode'
+    }
+    delta['item'] = [result['member_account'], result['member_region']]
+    return delta
@@ -0,0 +1,315 @@
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from sh_clients import get_client
+from sh_fanout import get_max_workers
+from sh_journal import STEP_ACCEPT_INVITE, STEP_ADD_MEMBER, STEP_ENABLE_MEMBER, get_checkpoint
+from sh_member_index import ASSOCIATED_STATUSES, CREATE_STATUSES, INVITE_STATUSES, get_member_statuses
+from sh_organization import ENROLMENT_ORGANIZATION
+from sh_standards import get_enabled_subscriptions, get_standards_catalogue, get_standards_changes
+from sh_store import get_store
+
+# Plan/apply mode for the SecurityHub Enabler.
+#   plan  - reads the current state in bulk, once: the Admin's hub and the
+#           member status of every account per Region (one ListMembers
+#           each), the enabled standards of every member (one role
+#           assumption per account, one GetEnabledStandards per Region) and
+#           the completed steps in the checkpoint journal; then
+#           writes the actions of every account x Region with the estimated
+#           API calls, role assumptions, Lambda seconds and duration
+#   apply - runs the plan: executions start only for the accounts and
+#           Regions with actions, the handlers run only the planned steps
+#           and take the member status from the plan instead of ListMembers
+# The enrolment mode of every Region is fixed when planning (the summary's
+# enrolment_modes) and apply reuses it, so the steps it plans are the ones
+# the items run.
+# Plan entries (plan_ttl seconds):
+#   plan#<id>                   summary, estimate and planned accounts
+#   plan#<id>#account#<account> member and { region: { actions, member_status, standards } }
+#   plan#<id>#region#<region>   ListMembers snapshot of the Region
+# A missing or expired plan entry never skips work, the step just runs.
+# The launcher writes the plan and the handlers of other Lambdas read it,
+# so plan/apply is refused on a store local to the Lambda container: memory,
+# and file and sqlite, which live in the container's /tmp.
+#
+# Environment Variables
+# plan_backend (memory | file | sqlite | dynamodb, default store_backend; dynamodb in the template)
+# plan_location (file path or table name, default store_location)
+# plan_ttl (optional, seconds, default 86400)
+# plan_read_standards (optional, yes | no, read the members' enabled standards, default yes)
+# plan_call_latency_ms (optional, estimated latency per API call, default 150)
+# plan_invocation_ms (optional, estimated overhead per Lambda invocation, default 100)
+# plan_admin_calls_per_second (optional, Admin-side SecurityHub calls per Region, default 9)
+#
+
+DEFAULT_TTL_SECONDS = 24 * 3600
+DEFAULT_CALL_LATENCY_MS = 150
+DEFAULT_INVOCATION_MS = 100
+# securityhub.* rate limit with the limiter's headroom
+DEFAULT_ADMIN_CALLS_PER_SECOND = 9
+
+# Enable Member, Add Member and Accept Invite per Region, one event per execution
+INVOCATIONS_PER_REGION = 3
+INVOCATIONS_PER_EXECUTION = 1
+
+# backends other Lambdas (and containers) cannot read, files included
+PROCESS_LOCAL_BACKENDS = ('memory', 'file', 'sqlite')
+
+_lock = threading.Lock()
+_entries = {}
+
+def get_plan_backend():
+    return os.environ.get('plan_backend') or os.environ.get('store_backend', 'memory')
+
+def is_plan_store_shared():
+    return get_plan_backend() not in PROCESS_LOCAL_BACKENDS
+
+def get_plan_store():
+    return get_store(os.environ.get('plan_backend'), os.environ.get('plan_location'))
+
+def plan_key(plan_id, *parts):
+    return '#'.join(('plan', plan_id) + parts)
+
+def get_plan_entry(plan_id, *parts):
+    # read once per container, plans do not change once written
+    key = plan_key(plan_id, *parts)
+    with _lock:
+        if key in _entries:
+            return _entries[key]
+    entry = get_plan_store().get(key)
+    if entry is not None:
+        with _lock:
+            _entries[key] = entry
+    return entry
+
+def get_planned_actions(item):
+    # None when the item is not applied from a plan, or the plan is gone
+    plan_id = item.get('plan_id')
+    if not plan_id:
+        return None
+    try:
+        account = get_plan_entry(plan_id, 'account', item['member_account'])
+    except Exception as e:
+        print('Failed to read plan: {} for Account: {}'.format(plan_id, item['member_account']))
+        print(str(e))
+        return None
+    if account is None:
+        return None
+    return account['regions'].get(item['member_region'], { 'actions': [] })['actions']
+
+def is_planned(item, step):
+    actions = get_planned_actions(item)
+    return actions is None or step in actions
+
+def get_planned_member_statuses(item):
+    # ListMembers snapshot the plan was made on, None without a plan
+    plan_id = item.get('plan_id')
+    if not plan_id:
+        return None
+    try:
+        return get_plan_entry(plan_id, 'region', item['member_region'])
+    except Exception as e:
+        print('Failed to read plan: {} for Region: {}'.format(plan_id, item['member_region']))
+        print(str(e))
+        return None
+
+def read_member_standards(member_session, regions):
+    # { region: { 'enabled', 'subscriptions' } } of one member account
+    standards = {}
+    for region in regions:
+        sh_client = get_client(member_session, 'securityhub', region)
+        try:
+            standards[region] = { 'enabled': True, 'subscriptions': get_enabled_subscriptions(sh_client) }
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidAccessException':
+                raise
+            # SecurityHub not enabled in the Region
+            standards[region] = { 'enabled': False, 'subscriptions': {} }
+    return standards
+
+def read_members_standards(members, regions, get_member_session):
+    # { account: { region: .. } }, accounts that cannot be read are left out
+    # and planned from the checkpoint journal instead
+    def read(member):
+        try:
+            return member['account_id'], read_member_standards(get_member_session(member['account_id']), regions)
+        except Exception as e:
+            print('Failed to read standards of Account: {}'.format(member['account_id']))
+            print(str(e))
+            return member['account_id'], None
+    with ThreadPoolExecutor(max_workers=get_max_workers(len(members))) as executor:
+        return { account: standards for account, standards in executor.map(read, members) if standards is not None }
+
+def get_region_standards_changes(region, standards, security_standards):
+    # EnableSecurityHub turns on the default standards (both of the catalogue)
+    subscriptions = standards['subscriptions'] if standards['enabled'] else \
+        { standard_arn: standard_arn for standard_arn in get_standards_catalogue(region).values() }
+    return get_standards_changes(region, subscriptions, security_standards)
+
+def plan_region_actions(member_account, region, member_status, sh_admin_account, security_standards, organization, standards=None):
+    # standards: what read_member_standards read for the Region, None if unknown
+    # organization: the Region's enrolment mode is organization
+    actions = []
+    if not organization:
+        if standards is not None:
+            to_enable, to_disable = get_region_standards_changes(region, standards, security_standards)
+            if not standards['enabled'] or len(to_enable) > 0 or len(to_disable) > 0:
+                actions.append(STEP_ENABLE_MEMBER)
+        else:
+            checkpoint = get_checkpoint(member_account, region, STEP_ENABLE_MEMBER)
+            if checkpoint is None or checkpoint.get('security_standards') != security_standards:
+                actions.append(STEP_ENABLE_MEMBER)
+    if member_status not in ASSOCIATED_STATUSES:
+        if get_checkpoint(member_account, region, STEP_ADD_MEMBER, sh_admin_account) is None:
+            actions.append(STEP_ADD_MEMBER)
+        # in organization mode too: accounts the Admin cannot associate take the invite path
+        if get_checkpoint(member_account, region, STEP_ACCEPT_INVITE, sh_admin_account) is None:
+            actions.append(STEP_ACCEPT_INVITE)
+    return actions
+
+def estimate_region_calls(region, actions, member_status, security_standards, organization, standards=None):
+    calls = Counter()
+    if STEP_ENABLE_MEMBER in actions:
+        calls['securityhub.EnableSecurityHub'] += 1
+        calls['securityhub.GetEnabledStandards'] += 1
+        if standards is not None:
+            to_enable, to_disable = get_region_standards_changes(region, standards, security_standards)
+            if len(to_enable) > 0:
+                calls['securityhub.BatchEnableStandards'] += 1
+            if len(to_disable) > 0:
+                calls['securityhub.BatchDisableStandards'] += 1
+        # EnableSecurityHub turns on both default standards
+        elif any(value != 'yes' for standard in security_standards for value in standard.values()):
+            calls['securityhub.BatchDisableStandards'] += 1
+    if STEP_ADD_MEMBER in actions:
+        if member_status in CREATE_STATUSES:
+            calls['securityhub.CreateMembers'] += 1
+            if organization:
+                calls['securityhub.GetMembers'] += 1
+        if not organization and member_status in INVITE_STATUSES:
+            calls['securityhub.InviteMembers'] += 1
+    # organization accounts are associated by CreateMembers, nothing to accept
+    if STEP_ACCEPT_INVITE in actions and not organization:
+        calls['securityhub.GetAdministratorAccount'] += 1
+        calls['securityhub.ListInvitations'] += 1
+        calls['securityhub.AcceptAdministratorInvitation'] += 1
+    return calls
+
+def estimate_admin_region_calls(admin_enabled):
+    # DescribeHub probe, cached per warm container; enable and standards when off
+    calls = Counter({ 'securityhub.DescribeHub': 1 })
+    if not admin_enabled:
+        calls.update({ 'securityhub.EnableSecurityHub': 1, 'securityhub.GetEnabledStandards': 1, 'securityhub.BatchEnableStandards': 1 })
+    return calls
+
+def build_plan(plan_id, sh_admin_session, sh_admin_account, members, regions, security_standards, enrolment_modes, get_member_session=None):
+    # members: list of { 'account_id', 'email', 'org_unit_id', .. }
+    # enrolment_modes: { region: enrolment mode } the executions will run with
+    # get_member_session(account): session to read the member's standards,
+    # None plans Enable Member from the checkpoint journal only
+    # returns (summary, { account: account entry }, { region: statuses })
+    call_latency = float(os.environ.get('plan_call_latency_ms', DEFAULT_CALL_LATENCY_MS)) / 1000
+    invocation = float(os.environ.get('plan_invocation_ms', DEFAULT_INVOCATION_MS)) / 1000
+    admin_rate = float(os.environ.get('plan_admin_calls_per_second', DEFAULT_ADMIN_CALLS_PER_SECOND))
+    region_statuses = {}
+    calls = Counter()
+    admin_calls = Counter()
+    for region in regions:
+        statuses = get_member_statuses(get_client(sh_admin_session, 'securityhub', region))
+        region_statuses[region] = statuses or {}
+        region_calls = estimate_admin_region_calls(statuses is not None)
+        calls.update(region_calls)
+        admin_calls[region] += sum(region_calls.values())
+    # Enable Member runs in the invite Regions only
+    invite_regions = [region for region in regions if enrolment_modes[region] != ENROLMENT_ORGANIZATION]
+    members_standards = {}
+    read_role_assumptions = 0
+    if get_member_session is not None and len(invite_regions) > 0:
+        members_standards = read_members_standards(members, invite_regions, get_member_session)
+        read_role_assumptions = len(members)
+    accounts = {}
+    actions = Counter()
+    role_assumptions = 1
+    lambda_seconds = 0.0
+    execution_seconds = []
+    for member in members:
+        member_account = member['account_id']
+        planned = {}
+        for region in regions:
+            organization = enrolment_modes[region] == ENROLMENT_ORGANIZATION
+            member_status = region_statuses[region].get(member_account)
+            standards = members_standards.get(member_account, {}).get(region)
+            region_actions = plan_region_actions(member_account, region, member_status, sh_admin_account, security_standards,
+                organization, standards)
+            if len(region_actions) == 0:
+                continue
+            region_calls = estimate_region_calls(region, region_actions, member_status, security_standards, organization, standards)
+            calls.update(region_calls)
+            actions.update(region_actions)
+            admin_calls[region] += region_calls['securityhub.CreateMembers'] + region_calls['securityhub.GetMembers'] + region_calls['securityhub.InviteMembers']
+            planned[region] = {
+                'actions': region_actions,
+                'member_status': member_status,
+                'member_session': STEP_ENABLE_MEMBER in region_actions or (STEP_ACCEPT_INVITE in region_actions and not organization),
+                'calls': sum(region_calls.values())
+            }
+            if standards is not None and STEP_ENABLE_MEMBER in region_actions:
+                to_enable, to_disable = get_region_standards_changes(region, standards, security_standards)
+                planned[region]['standards'] = {
+                    'hub_enabled': standards['enabled'],
+                    'enable': to_enable,
+                    'disable': to_disable
+                }
+        if len(planned) == 0:
+            continue
+        accounts[member_account] = { 'member': member, 'regions': planned }
+        if any(region['member_session'] for region in planned.values()):
+            role_assumptions += 1
+        # the Map runs one Region at a time, every step is invoked
+        seconds = sum(region['calls'] for region in planned.values()) * call_latency + \
+            (len(planned) * INVOCATIONS_PER_REGION + INVOCATIONS_PER_EXECUTION) * invocation
+        execution_seconds.append(seconds)
+        lambda_seconds += seconds
+    calls['sts.AssumeRole'] += role_assumptions
+    calls['stepfunctions.StartExecution'] += len(accounts)
+    calls['events.PutEvents'] += len(accounts)
+    # executions run side by side, the Admin's per-Region rate limit caps them
+    duration = max(execution_seconds + [count / admin_rate for count in admin_calls.values()] + [0])
+    summary = {
+        'plan_id': plan_id,
+        'created_at': int(time.time()),
+        'sh_admin_account': sh_admin_account,
+        'enrolment_modes': enrolment_modes,
+        'regions': regions,
+        'members': len(members),
+        'accounts': sorted(accounts),
+        'pairs': sum(len(account['regions']) for account in accounts.values()),
+        'actions': dict(actions),
+        'read': {
+            'member_standards': len(members_standards),
+            'role_assumptions': read_role_assumptions
+        },
+        'estimate': {
+            'api_calls': sum(calls.values()),
+            'calls': dict(sorted(calls.items())),
+            'role_assumptions': role_assumptions,
+            'executions': len(accounts),
+            'lambda_seconds': round(lambda_seconds, 1),
+            'duration_seconds': round(duration, 1)
+        }
+    }
+    return summary, accounts, region_statuses
+
+def save_plan(summary, accounts, region_statuses):
+    store = get_plan_store()
+    ttl = int(os.environ.get('plan_ttl', DEFAULT_TTL_SECONDS))
+    plan_id = summary['plan_id']
+    for region, statuses in region_statuses.items():
+        store.put(plan_key(plan_id, 'region', region), statuses, ttl)
+    for member_account, account in accounts.items():
+        store.put(plan_key(plan_id, 'account', member_account), account, ttl)
+    # the summary last: a plan is complete once it can be read
+    store.put(plan_key(plan_id), summary, ttl)
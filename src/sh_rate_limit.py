@@ -0,0 +1,198 @@
+import os
+import threading
+import time
+from sh_clients import get_client, register_client_hook
+from sh_credentials import get_session_account
+
+# Client-side rate limiter for the SecurityHub control-plane calls.
+# Every call waits for a token of the bucket of its (account, region,
+# operation), so concurrent threads stay at the API limit instead of
+# collapsing into TooManyRequests retries. Runs ahead of botocore's
+# adaptive retry mode, which still backs off on the throttles that get
+# through; a throttled response also empties the bucket.
+#   local    - token buckets shared by the threads of one container (default)
+#   dynamodb - one-second windows counted in a DynamoDB table, shared by
+#              all containers; location is the table name, with a string
+#              partition key 'pk' and 'expires_at' as TTL attribute.
+#              DynamoDB Local can stand in through aws_endpoint_url.
+#
+# Environment Variables
+# rate_limit_enabled (optional, default yes)
+# rate_limits (optional, service.Operation=rate:burst,.. e.g. securityhub.CreateMembers=1:1,securityhub.*=10:30)
+# rate_limit_backend (optional, local | dynamodb, default local)
+# rate_limit_location (table name, required for dynamodb)
+# rate_limit_headroom (optional, fraction of the limits to use, default 0.9)
+#
+
+# published SecurityHub limits, per account and region
+DEFAULT_RATE_LIMITS = {
+    'securityhub.*': (10, 30),
+    'securityhub.GetFindings': (3, 6),
+    'securityhub.BatchEnableStandards': (1, 1),
+    'securityhub.BatchDisableStandards': (1, 1),
+    'securityhub.UpdateStandardsControl': (1, 5)
+}
+
+# calls released exactly at the limit reach the API with network jitter,
+# some of them a little early, so stay just under it
+DEFAULT_HEADROOM = 0.9
+
+THROTTLE_CODES = (
+    'Throttling',
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'LimitExceededException'
+)
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # take a token, going negative reserves the next one in line,
+        # then sleep outside the lock until it is due
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def drain(self):
+        with self.lock:
+            self.tokens = min(self.tokens, 0)
+
+class LocalLimiter:
+    def __init__(self, location=None):
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def get_bucket(self, key, rate, burst):
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(rate, burst)
+                self.buckets[key] = bucket
+        return bucket
+
+    def acquire(self, key, rate, burst):
+        return self.get_bucket(key, rate, burst).acquire()
+
+    def throttled(self, key, rate, burst):
+        self.get_bucket(key, rate, burst).drain()
+
+class DynamoDBLimiter:
+    def __init__(self, location):
+        # boto3 is only needed by this backend
+        import boto3
+        self.table_name = location
+        self.client = get_client(boto3.Session(), 'dynamodb')
+
+    def acquire(self, key, rate, burst):
+        # atomic counter per one-second window, wait for the next window when full
+        allowance = max(1, int(rate))
+        waited = 0
+        while True:
+            now = time.time()
+            window = int(now)
+            response = self.client.update_item(
+                TableName=self.table_name,
+                Key={ 'pk': { 'S': 'rate#{}#{}'.format('#'.join(key), window) } },
+                UpdateExpression='ADD calls :one SET expires_at = :expires_at',
+                ExpressionAttributeValues={
+                    ':one': { 'N': '1' },
+                    ':expires_at': { 'N': str(window + 60) }
+                },
+                ReturnValues='UPDATED_NEW'
+            )
+            if int(response['Attributes']['calls']['N']) <= allowance:
+                return waited
+            wait = window + 1 - now
+            time.sleep(wait)
+            waited += wait
+
+    def throttled(self, key, rate, burst):
+        # the window counter already holds the others back
+        pass
+
+BACKENDS = {
+    'local': LocalLimiter,
+    'dynamodb': DynamoDBLimiter
+}
+
+_lock = threading.Lock()
+_limiter = None
+_rate_limits = None
+_installed = False
+
+def parse_rate_limits(value):
+    rate_limits = dict(DEFAULT_RATE_LIMITS)
+    for entry in filter(None, (entry.strip() for entry in value.split(','))):
+        name, limit = entry.split('=')
+        rate, burst = limit.split(':') if ':' in limit else (limit, limit)
+        rate_limits[name.strip()] = (float(rate), float(burst))
+    return rate_limits
+
+def get_rate_limits():
+    global _rate_limits
+    if _rate_limits is None:
+        _rate_limits = parse_rate_limits(os.environ.get('rate_limits', ''))
+    return _rate_limits
+
+def get_rate_limit(service, operation):
+    # (rate, burst) with the headroom applied, None if the call is not limited
+    rate_limits = get_rate_limits()
+    limit = rate_limits.get('{}.{}'.format(service, operation), rate_limits.get('{}.*'.format(service)))
+    if limit is None:
+        return None
+    headroom = float(os.environ.get('rate_limit_headroom', DEFAULT_HEADROOM))
+    return (limit[0] * headroom, max(1, limit[1] * headroom))
+
+def get_limiter():
+    global _limiter
+    if _limiter is None:
+        with _lock:
+            if _limiter is None:
+                _limiter = BACKENDS[os.environ.get('rate_limit_backend', 'local')](os.environ.get('rate_limit_location'))
+    return _limiter
+
+def attach(client, session):
+    service = client.meta.service_model.service_name
+    # only services with a configured limit get the handlers
+    if not any(name.split('.')[0] == service for name in get_rate_limits()):
+        return
+    account = get_session_account(session) or 'self'
+    region = client.meta.region_name
+
+    def before_parameter_build(model, **kwargs):
+        limit = get_rate_limit(service, model.name)
+        if limit is not None:
+            waited = get_limiter().acquire((account, region, model.name), *limit)
+            if waited > 1:
+                print('Rate limited {} for Account: {} in Region: {} for {:.1f}s'.format(model.name, account, region, waited))
+
+    def needs_retry(response, operation, **kwargs):
+        if response is None or not isinstance(response[1], dict):
+            return
+        limit = get_rate_limit(service, operation.name)
+        if limit is not None and response[1].get('Error', {}).get('Code') in THROTTLE_CODES:
+            get_limiter().throttled((account, region, operation.name), *limit)
+
+    client.meta.events.register('before-parameter-build', before_parameter_build, unique_id='sh-rate-limit-before-parameter-build')
+    client.meta.events.register('needs-retry', needs_retry, unique_id='sh-rate-limit-needs-retry')
+
+def install_rate_limiter():
+    # once per container, for every client built after this
+    global _installed
+    with _lock:
+        if _installed or os.environ.get('rate_limit_enabled', 'yes') != 'yes':
+            return
+        _installed = True
+    register_client_hook(attach)
@@ -1,11 +1,21 @@
-import sys
 import boto3
 import json
-import urllib3
 import os
+import re
+import hashlib
+import threading
+import time
+import uuid
 import logging
-from datetime import date, datetime
-from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from sh_clients import get_client
+from sh_credentials import assume_role
+from sh_drift import ADMIN_NOT_ENABLED, find_region_drift, get_drift_backend, get_drift_store, is_drift_store_shared, list_governed_accounts, reconcile_admin_standards
+from sh_metrics import metrics_handler
+from sh_organization import ENROLMENT_INVITE, ENROLMENT_ORGANIZATION, get_enrolment_mode, setup_organization_region
+from sh_payload import compact_input
+from sh_plan import build_plan, get_plan_backend, get_plan_entry, is_plan_store_shared, save_plan
+from sh_store import get_store
 
 LOGGER = logging.getLogger()
 if 'log_level' in os.environ:
@@ -14,14 +24,22 @@ if 'log_level' in os.environ:
 else:
     LOGGER.setLevel(logging.ERROR)
 
-session = boto3.Session()
-
 # globals
+# StartExecution input and state data are limited to 256 KB; the Map output
+# keeps a result per item (about 550 bytes, 400 in compact input), so a
+# coalesced execution is sized by the larger of its input and its output
+DEFAULT_COALESCE_MAX_EXECUTION_BYTES = 192 * 1024
+ITEM_RESULT_BYTES = 640
+session = None
+sm_arn = None
+sm_arn_lock = threading.Lock()
 
-def json_serial(obj):
-    if isinstance(obj, (datetime, date)):
-        return obj.isoformat()
-    raise TypeError('Type %s not serializable' % type(obj))
+def get_session():
+    # built on first use, not at import
+    global session
+    if session is None:
+        session = boto3.Session()
+    return session
 
 def get_account_from_ct_event(event):
     if 'detail' in event:
@@ -39,7 +57,7 @@ def get_account_from_ct_event(event):
                         'org_unit_id': org_unit_id,
                         'state': state
                     }
-                org_client = session.client('organizations')
+                org_client = get_client(get_session(), 'organizations')
                 account_data = org_client.describe_account(AccountId=account_id)
                 email = account_data['Account']['Email']
                 return {
@@ -49,9 +67,27 @@ def get_account_from_ct_event(event):
                     'state': state
                 }
 
-def get_ct_regions(account_id):
+def get_ct_regions(account_id, refresh=False):
+    # governed regions rarely change, serve them from the region cache
+    store = get_store()
+    cache_key = 'ct_regions#{}'.format(account_id)
+    if not refresh:
+        regions = store.get(cache_key)
+        if regions is not None:
+            print(f"Control Tower Regions (cached): {regions}")
+            return regions
+    regions = list_ct_regions(account_id)
+    if len(regions) > 0:
+        store.put(cache_key, regions, int(os.environ.get('region_cache_ttl', 3600)))
+    return regions
+
+def invalidate_ct_regions(account_id):
+    get_store().delete('ct_regions#{}'.format(account_id))
+    print(f"Control Tower Regions cache invalidated for Account: {account_id}")
+
+def list_ct_regions(account_id):
     # use CT session
-    cf_client = session.client('cloudformation')
+    cf_client = get_client(get_session(), 'cloudformation')
     region_set = set()
     try:
         # stack instances are outdated
@@ -67,31 +103,80 @@ def get_ct_regions(account_id):
     print(f"Control Tower Regions: {list(region_set)}")
     return list(region_set)
 
-def start_workflow(input):
+def get_state_machine_arn(sfn_client, sm_name):
+    # resolved once per container: from configuration, else by paginated search
+    global sm_arn
+    with sm_arn_lock:
+        if sm_arn is None:
+            if os.environ.get('sm_arn'):
+                sm_arn = os.environ['sm_arn']
+            else:
+                print('Search for StateMachine Name: {} ..'.format(sm_name))
+                paginator = sfn_client.get_paginator('list_state_machines')
+                for page in paginator.paginate():
+                    for sm in page['stateMachines']:
+                        if sm['name'] == sm_name:
+                            sm_arn = sm['stateMachineArn']
+                            break
+                    if sm_arn is not None:
+                        break
+        return sm_arn
+
+def get_execution_name(account_id, event_id):
+    # deterministic and unique per (account, event): a redelivered event maps
+    # to the same name, so Step Functions rejects the duplicate execution
+    name = re.sub(r'[^A-Za-z0-9_-]', '-', '{}-{}'.format(account_id, event_id))
+    if len(name) > 80:
+        name = '{}-{}'.format(account_id, hashlib.sha1(name.encode()).hexdigest())
+    return name
+
+def format_input(input):
+    # compact input keeps the shared fields once, see sh_payload
+    if os.environ.get('input_format') == 'compact':
+        return compact_input(input)
+    return input
+
+def start_workflow(input, exec_id):
     sm_name = os.environ['sm_name']
-    print('Search for StateMachine Name: {} ..'.format(sm_name))
+    sfn_client = get_client(get_session(), 'stepfunctions')
     try:
-        sfn_client = session.client('stepfunctions')
-        sm_arn = ''
-        exec_id = date.strftime(datetime.now(), '%Y%m%d%I%M%S')
-        response = sfn_client.list_state_machines()
-        for sm in response['stateMachines']:
-            if sm['name'] == sm_name:
-                sm_arn = sm['stateMachineArn']
-                break
+        sm_arn = get_state_machine_arn(sfn_client, sm_name)
         print("Invoking StateMachine Arn: {} ..".format(sm_arn))
         response = sfn_client.start_execution(
             stateMachineArn=sm_arn,
             name=exec_id,
-            input=json.dumps(input)
+            input=json.dumps(format_input(input))
         )
         execArn = response['executionArn']
         print('StateMachine: {} started with Execution ARN: {}'.format(sm_name, execArn))
+        return True
+    except sfn_client.exceptions.ExecutionAlreadyExists:
+        print('StateMachine: {} Execution: {} already started'.format(sm_name, exec_id))
+        return True
     except Exception as e:
         print('Failed to execute StateMachine: {}'.format(sm_name))
         print(str(e))
+        return False
+
+def get_region_enrolment_modes(sh_regions):
+    # organization mode needs the delegated administrator and auto-enable set
+    # up once per Region; Regions where that failed fall back to invites.
+    # Called once per run, the runs that start many executions hand the
+    # modes to prepare_input instead of setting Regions up from every thread
+    if get_enrolment_mode() != ENROLMENT_ORGANIZATION:
+        return { region: ENROLMENT_INVITE for region in sh_regions }
+    sh_admin_account = os.environ['sh_admin_account']
+    security_standards = [ { 'aws': os.environ['enable_aws_standard'], 'cis': os.environ['enable_cis_standard'] } ]
+    def get_admin_session():
+        return assume_role(os.environ['org_id'], sh_admin_account, os.environ['assume_role'])
+    return {
+        region: ENROLMENT_ORGANIZATION
+        if setup_organization_region(get_session(), get_admin_session, sh_admin_account, region, security_standards)
+        else ENROLMENT_INVITE
+        for region in sh_regions
+    }
 
-def prepare_input(event, member):
+def prepare_input(event, member, sh_regions=None, skip_journal=False, plan_id=None, enrolment_modes=None):
     org_id = os.environ['org_id']
     ct_home_region = os.environ['ct_home_region']
     sh_admin_account = os.environ['sh_admin_account']
@@ -102,7 +187,12 @@ def prepare_input(event, member):
     member_account = member['account_id']
     member_email = member['email']
     ou_id = member['org_unit_id']
-    sh_regions = get_ct_regions(sh_admin_account)
+    if sh_regions is None:
+        sh_regions = get_ct_regions(sh_admin_account)
+    if enrolment_modes is None:
+        enrolment_modes = get_region_enrolment_modes(sh_regions)
+    # member views built before this are older than what the launcher saw
+    dispatched_at = int(time.time())
     sh_member_regions = []
     for region in sh_regions:
         sh_member_regions.append({
@@ -116,18 +206,323 @@ def prepare_input(event, member):
             'enable_cis_standard': enable_cis_standard,
             'member_account': member_account,
             'member_email': member_email,
-            'member_region': region
+            'member_region': region,
+            'skip_journal': skip_journal,
+            'dispatched_at': dispatched_at,
+            'enrolment_mode': enrolment_modes[region],
+            'plan_id': plan_id
         })
     return sh_member_regions
 
+def list_ou_accounts(org_client, org_unit_id, recursive):
+    # streams ACTIVE accounts of the OU (and child OUs), each page listed once
+    # list_accounts_for_parent returns the Email, no describe_account needed
+    accounts_paginator = org_client.get_paginator('list_accounts_for_parent')
+    for page in accounts_paginator.paginate(ParentId=org_unit_id):
+        for account in page['Accounts']:
+            if account['Status'] == 'ACTIVE':
+                yield {
+                    'account_id': account['Id'],
+                    'email': account['Email'],
+                    'org_unit_id': org_unit_id,
+                    'state': 'SUCCEEDED'
+                }
+    if recursive:
+        ou_paginator = org_client.get_paginator('list_organizational_units_for_parent')
+        for page in ou_paginator.paginate(ParentId=org_unit_id):
+            for child_ou in page['OrganizationalUnits']:
+                yield from list_ou_accounts(org_client, child_ou['Id'], recursive)
+
+def chunked(iterable, size):
+    chunk = []
+    for entry in iterable:
+        chunk.append(entry)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+def backfill_ou(event, event_id, org_unit_id, recursive):
+    # one execution per account, started in bounded chunks
+    chunk_size = int(os.environ.get('backfill_chunk_size', 10))
+    sh_admin_account = os.environ['sh_admin_account']
+    sh_regions = get_ct_regions(sh_admin_account)
+    enrolment_modes = get_region_enrolment_modes(sh_regions)
+    org_client = get_client(get_session(), 'organizations')
+    started = 0
+    failed = []
+    # the Admin account is not its own member
+    members = (member for member in list_ou_accounts(org_client, org_unit_id, recursive) if member['account_id'] != sh_admin_account)
+    def dispatch(member):
+        try:
+            input = prepare_input(event, member, sh_regions, enrolment_modes=enrolment_modes)
+            return start_workflow(input, get_execution_name(member['account_id'], event_id))
+        except Exception as e:
+            print('Failed to start backfill for Account: {}'.format(member['account_id']))
+            print(str(e))
+            return False
+    for chunk in chunked(members, chunk_size):
+        with ThreadPoolExecutor(max_workers=len(chunk)) as executor:
+            for member, succeeded in zip(chunk, executor.map(dispatch, chunk)):
+                if succeeded:
+                    started += 1
+                else:
+                    failed.append(member['account_id'])
+        print('Backfill of OU: {} started {} executions so far, {} failed'.format(org_unit_id, started, len(failed)))
+    return { 'org_unit_id': org_unit_id, 'started': started, 'failed': failed }
+
+def get_plan_store_error():
+    # the handlers that apply a plan run in other Lambdas
+    if is_plan_store_shared():
+        return None
+    error = 'Plan store backend: {} is local to this container, set plan_backend to dynamodb'.format(get_plan_backend())
+    print(error)
+    return error
+
+def plan_ou(event, event_id, org_unit_id, recursive):
+    # plan: read state in bulk, write the actions and the estimate; changes
+    # nothing but the organization setup of the Regions, whose modes it fixes
+    error = get_plan_store_error()
+    if error is not None:
+        return { 'org_unit_id': org_unit_id, 'error': error }
+    sh_admin_account = os.environ['sh_admin_account']
+    security_standards = [ { 'aws': os.environ['enable_aws_standard'], 'cis': os.environ['enable_cis_standard'] } ]
+    sh_regions = get_ct_regions(sh_admin_account)
+    # the modes apply will run with, a Region whose organization setup fails plans the invite path
+    enrolment_modes = get_region_enrolment_modes(sh_regions)
+    org_client = get_client(get_session(), 'organizations')
+    members = [member for member in list_ou_accounts(org_client, org_unit_id, recursive) if member['account_id'] != sh_admin_account]
+    sh_admin_session = assume_role(os.environ['org_id'], sh_admin_account, os.environ['assume_role'])
+    plan_id = get_execution_name('plan', event_id)
+    def get_member_session(account):
+        return assume_role(os.environ['org_id'], account, os.environ['assume_role'])
+    read_standards = os.environ.get('plan_read_standards', 'yes') == 'yes'
+    summary, accounts, region_statuses = build_plan(plan_id, sh_admin_session, sh_admin_account, members, sh_regions,
+        security_standards, enrolment_modes, get_member_session if read_standards else None)
+    summary['org_unit_id'] = org_unit_id
+    save_plan(summary, accounts, region_statuses)
+    estimate = summary['estimate']
+    print('Plan: {} for OU: {}: {} of {} Accounts in {} Regions need {} actions'.format(
+        plan_id, org_unit_id, len(accounts), len(members), len(sh_regions), sum(summary['actions'].values())
+    ))
+    print('Read: enabled standards of {} Accounts'.format(summary['read']['member_standards']))
+    print('Estimate: {} API calls, {} role assumptions, {} Lambda seconds, about {} seconds'.format(
+        estimate['api_calls'], estimate['role_assumptions'], estimate['lambda_seconds'], estimate['duration_seconds']
+    ))
+    return summary
+
+def apply_plan(event, event_id, plan_id):
+    # apply: executions only for the planned accounts and Regions
+    error = get_plan_store_error()
+    if error is not None:
+        return { 'plan_id': plan_id, 'started': 0, 'error': error }
+    summary = get_plan_entry(plan_id)
+    if summary is None:
+        print('Plan: {} not found or expired'.format(plan_id))
+        return { 'plan_id': plan_id, 'started': 0 }
+    # the modes the plan was made for, not recomputed
+    enrolment_modes = summary['enrolment_modes']
+    def dispatch(member_account):
+        account = get_plan_entry(plan_id, 'account', member_account)
+        if account is None:
+            print('Plan: {} has no entry for Account: {}'.format(plan_id, member_account))
+            return False
+        input = prepare_input(event, account['member'], sorted(account['regions']), plan_id=plan_id, enrolment_modes=enrolment_modes)
+        return start_workflow(input, get_execution_name(member_account, 'apply-{}'.format(plan_id)))
+    chunk_size = int(os.environ.get('backfill_chunk_size', 10))
+    started = 0
+    for chunk in chunked(summary['accounts'], chunk_size):
+        with ThreadPoolExecutor(max_workers=len(chunk)) as executor:
+            started += sum(executor.map(dispatch, chunk))
+        print('Apply of Plan: {} started {} executions so far'.format(plan_id, started))
+    return { 'plan_id': plan_id, 'started': started, 'estimate': summary['estimate'] }
+
+def list_account_emails(org_client, account_ids):
+    emails = {}
+    paginator = org_client.get_paginator('list_accounts')
+    for page in paginator.paginate():
+        for account in page['Accounts']:
+            if account['Id'] in account_ids:
+                emails[account['Id']] = account['Email']
+    return emails
+
+def get_org_unit_id(org_client, account_id):
+    parents = org_client.list_parents(ChildId=account_id)['Parents']
+    return parents[0]['Id'] if len(parents) > 0 else ''
+
+def drift_sweep(event, event_id):
+    # scheduled every compliance_frequency days: reads Admin-side state in bulk
+    # per Region and starts executions only for the drifted (account, region)
+    # pairs; they skip the checkpoint journal, which would mark them done
+    sh_admin_account = os.environ['sh_admin_account']
+    security_standards = [ { 'aws': os.environ['enable_aws_standard'], 'cis': os.environ['enable_cis_standard'] } ]
+    redispatch_after = int(os.environ.get('drift_redispatch_after', 86400))
+    store = get_drift_store()
+    if not is_drift_store_shared():
+        print('Drift store backend: {} is local to this container, the sweep cannot skip pairs dispatched by earlier sweeps'.format(
+            get_drift_backend()))
+    governed = list_governed_accounts(get_client(get_session(), 'cloudformation'))
+    governed.pop(sh_admin_account, None)
+    regions = sorted(set(region for account_regions in governed.values() for region in account_regions))
+    sh_admin_session = assume_role(os.environ['org_id'], sh_admin_account, os.environ['assume_role'])
+    drifted = {}
+    admin_regions = []
+    for region in regions:
+        accounts = [account for account, account_regions in governed.items() if region in account_regions]
+        region_drift = find_region_drift(sh_admin_session, sh_admin_account, region, accounts)
+        if ADMIN_NOT_ENABLED not in region_drift.values():
+            admin_regions.append(region)
+        for account, reason in region_drift.items():
+            # incremental: a fix started by a recent sweep is still in flight
+            if store.get('drift#{}#{}'.format(account, region)) is not None:
+                continue
+            print('Account: {} drifted in Region: {}: {}'.format(account, region, reason))
+            drifted.setdefault(account, []).append(region)
+    # fix: the Admin's own standards where its hub is enabled, the executions
+    # enable it (with the standards) where it is not
+    admin_standards_failed = [
+        region for region in admin_regions
+        if not reconcile_admin_standards(sh_admin_session, sh_admin_account, region, security_standards)
+    ]
+    started = 0
+    if len(drifted) > 0:
+        enrolment_modes = get_region_enrolment_modes(regions)
+        org_client = get_client(get_session(), 'organizations')
+        emails = list_account_emails(org_client, set(drifted))
+        def dispatch(account):
+            member = {
+                'account_id': account,
+                'email': emails[account],
+                'org_unit_id': get_org_unit_id(org_client, account),
+                'state': 'SUCCEEDED'
+            }
+            input = prepare_input(event, member, drifted[account], skip_journal=True, enrolment_modes=enrolment_modes)
+            if start_workflow(input, get_execution_name(account, 'drift-{}'.format(event_id))):
+                for region in drifted[account]:
+                    store.put('drift#{}#{}'.format(account, region), True, redispatch_after)
+                return True
+            return False
+        chunk_size = int(os.environ.get('backfill_chunk_size', 10))
+        with ThreadPoolExecutor(max_workers=min(chunk_size, len(drifted))) as executor:
+            started = sum(executor.map(dispatch, [account for account in drifted if account in emails]))
+    print('Drift sweep: {} accounts in {} Regions, {} drifted, {} executions started'.format(
+        len(governed), len(regions), len(drifted), started
+    ))
+    return {
+        'accounts': len(governed),
+        'regions': regions,
+        'drifted': drifted,
+        'started': started,
+        'admin_standards_failed': admin_standards_failed
+    }
+
+def buffer_member(queue_url, member, event_id):
+    # coalescing: park the enrolled account in the queue, the queue's event
+    # source mapping hands a window of accounts to flush_members
+    sqs_client = get_client(get_session(), 'sqs')
+    sqs_client.send_message(
+        QueueUrl=queue_url,
+        MessageBody=json.dumps({ 'member': member, 'event_id': event_id })
+    )
+    print('Account: {} buffered for the next StateMachine execution'.format(member['account_id']))
+
+def add_members_in_bulk(members, inputs):
+    # Admin side of a coalesced window, done once from the launcher: enable the
+    # Admin and create_members / invite_members for all accounts, up to
+    # member_batch_size per call, every Region at once on the admin engine.
+    # The executions' Add Member steps then find the accounts invited or
+    # associated in the member index and make no Admin-side calls.
+    # Failures are only printed, Add Member still runs for every item.
+    import asyncio
+    from sh_admin_enabler import run_admin_engine
+    sh_admin_account = os.environ['sh_admin_account']
+    security_standards = [ { 'aws': os.environ['enable_aws_standard'], 'cis': os.environ['enable_cis_standard'] } ]
+    regions_by_mode = {}
+    for item in inputs[0]:
+        regions_by_mode.setdefault(item['enrolment_mode'], []).append(item['member_region'])
+    bulk_members = [ { 'account': member['account_id'], 'email': member['email'] } for member in members ]
+    try:
+        sh_admin_session = assume_role(os.environ['org_id'], sh_admin_account, os.environ['assume_role'])
+        for enrolment_mode, regions in regions_by_mode.items():
+            results = asyncio.run(run_admin_engine(sh_admin_session, sh_admin_account, regions, bulk_members, security_standards,
+                enrolment_mode == ENROLMENT_ORGANIZATION))
+            failed = sum(1 for region_results in results.values() for result in region_results.values() if result['status'] == 'FAILED')
+            print('Added {} Accounts to Admin: {} in {} Regions ({}), {} failed'.format(
+                len(bulk_members), sh_admin_account, len(regions), enrolment_mode, failed
+            ))
+    except Exception as e:
+        print('Failed to add {} Accounts to Admin: {} in bulk'.format(len(bulk_members), sh_admin_account))
+        print(str(e))
+
+def get_execution_bytes(input):
+    return max(len(json.dumps(format_input(input))), len(input) * ITEM_RESULT_BYTES)
+
+def split_inputs(inputs, max_bytes):
+    # whole accounts per execution, each execution at most max_bytes
+    batch = []
+    for member_input in inputs:
+        if len(batch) > 0 and get_execution_bytes(batch + member_input) > max_bytes:
+            yield batch
+            batch = []
+        batch = batch + member_input
+    if len(batch) > 0:
+        yield batch
+
+def flush_members(event, records):
+    # executions covering all accounts buffered in the window
+    members = {}
+    for record in records:
+        body = json.loads(record['body'])
+        members[body['member']['account_id']] = body['member']
+    # sorted, so a redelivered window splits into the same executions
+    members = [members[account_id] for account_id in sorted(members)]
+    sh_regions = get_ct_regions(os.environ['sh_admin_account'])
+    enrolment_modes = get_region_enrolment_modes(sh_regions)
+    inputs = [prepare_input(event, member, sh_regions, enrolment_modes=enrolment_modes) for member in members]
+    add_members_in_bulk(members, inputs)
+    message_ids = ''.join(sorted(record['messageId'] for record in records))
+    batch_id = hashlib.sha1(message_ids.encode()).hexdigest()
+    max_bytes = int(os.environ.get('coalesce_max_execution_bytes', DEFAULT_COALESCE_MAX_EXECUTION_BYTES))
+    failed = []
+    for index, input in enumerate(split_inputs(inputs, max_bytes)):
+        exec_id = get_execution_name('batch', '{}-{}'.format(batch_id, index))
+        print('Flushing {} Accounts into Execution: {}'.format(len(set(item['member_account'] for item in input)), exec_id))
+        if not start_workflow(input, exec_id):
+            failed.append(exec_id)
+    if len(failed) > 0:
+        # let SQS redeliver the window (the queue's redrive policy caps the
+        # attempts), the execution names keep the started ones idempotent
+        raise Exception('Failed to start Executions: {}'.format(failed))
+    return len(members)
+
+@metrics_handler
 def lambda_handler(event, context):
     print(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
+    if 'Records' in event:
+        return flush_members(event, event['Records'])
+    event_id = event.get('id') or uuid.uuid4().hex
+    if 'invalidate_ct_regions' in event:
+        invalidate_ct_regions(os.environ['sh_admin_account'])
+        return
+    if 'drift_sweep' in event:
+        return drift_sweep(event, event_id)
+    if 'plan' in event:
+        plan = event['plan']
+        return plan_ou(event, event_id, plan['org_unit_id'], plan.get('recursive', False))
+    if 'apply' in event:
+        return apply_plan(event, event_id, event['apply']['plan_id'])
+    if 'backfill' in event:
+        backfill = event['backfill']
+        return backfill_ou(event, event_id, backfill['org_unit_id'], backfill.get('recursive', False))
     member = get_account_from_ct_event(event)
     print(json.dumps(member, indent=2))
     if member['state'] != 'SUCCEEDED':
         print('Account Enrolment for Account: %s is not in SUCCEEDED State. SecurityHub will not be enabled.' % member['account_id'])
+    elif os.environ.get('coalesce_queue_url'):
+        buffer_member(os.environ['coalesce_queue_url'], member, event_id)
     else:
         input = prepare_input(event, member)
-        start_workflow(input)
+        start_workflow(input, get_execution_name(member['account_id'], event_id))
 
 
@@ -0,0 +1,75 @@
+import json
+from functools import lru_cache
+
+# Declarative SecurityHub standards reconciler.
+# The desired standards ([ { 'aws': 'yes'|'no', 'cis': 'yes'|'no' } ]) are
+# compared with get_enabled_standards, then at most one BatchEnableStandards
+# and one BatchDisableStandards call is made per Region.
+
+# Standard ARN templates, keyed by the flag used in security_standards
+STANDARD_ARNS = {
+    # AWS Foundational Security Best Practices v1.0.0
+    'aws': 'arn:aws:securityhub:{region}::standards/aws-foundational-security-best-practices/v/1.0.0',
+    # CIS AWS Foundations Benchmark v1.2.0
+    'cis': 'arn:aws:securityhub:::ruleset/cis-aws-foundations-benchmark/v/1.2.0'
+}
+
+# subscriptions in these states are treated as not enabled
+INACTIVE_STATUSES = ('DELETING', 'FAILED')
+
+@lru_cache(maxsize=None)
+def get_standards_catalogue(region):
+    return { key: arn.format(region=region) for key, arn in STANDARD_ARNS.items() }
+
+def get_desired_standards(security_standards):
+    # returns (flags to enable, flags to disable), the last setting wins
+    desired = {}
+    for standard in security_standards:
+        for key in STANDARD_ARNS:
+            if standard.get(key) in ('yes', 'no'):
+                desired[key] = standard[key]
+    enable = [key for key, value in desired.items() if value == 'yes']
+    disable = [key for key, value in desired.items() if value == 'no']
+    return enable, disable
+
+def get_enabled_subscriptions(sh_client):
+    # StandardsArn -> StandardsSubscriptionArn
+    subscriptions = {}
+    paginator = sh_client.get_paginator('get_enabled_standards')
+    for page in paginator.paginate():
+        for subscription in page['StandardsSubscriptions']:
+            if subscription['StandardsStatus'] not in INACTIVE_STATUSES:
+                subscriptions[subscription['StandardsArn']] = subscription['StandardsSubscriptionArn']
+    return subscriptions
+
+def get_standards_changes(region, subscriptions, security_standards):
+    # (StandardsArns to enable, StandardsSubscriptionArns to disable)
+    catalogue = get_standards_catalogue(region)
+    enable, disable = get_desired_standards(security_standards)
+    to_enable = [catalogue[key] for key in enable if catalogue[key] not in subscriptions]
+    to_disable = [subscriptions[catalogue[key]] for key in disable if catalogue[key] in subscriptions]
+    return to_enable, to_disable
+
+def reconcile_standards(sh_client, sh_account, region, security_standards):
+    subscriptions = get_enabled_subscriptions(sh_client)
+    to_enable, to_disable = get_standards_changes(region, subscriptions, security_standards)
+    if len(to_enable) == 0 and len(to_disable) == 0:
+        print('Standards already match in Account: {} in Region: {}'.format(sh_account, region))
+    if len(to_enable) > 0:
+        response = sh_client.batch_enable_standards(
+            StandardsSubscriptionRequests=[
+                {
+                    'StandardsArn': standard_arn
+                } for standard_arn in to_enable
+            ]
+        )
+        print(json.dumps(response, default=str))
+        print('Standards: {} are enabled in Account: {} in Region: {}'.format(to_enable, sh_account, region))
+    if len(to_disable) > 0:
+        response = sh_client.batch_disable_standards(StandardsSubscriptionArns=to_disable)
+        print(json.dumps(response, default=str))
+        print('Standards: {} are disabled in Account: {} in Region: {}'.format(to_disable, sh_account, region))
+    return {
+        'enabled': to_enable,
+        'disabled': to_disable
+    }
@@ -0,0 +1,158 @@
+import os
+import json
+import threading
+import time
+from sh_clients import get_client
+
+# Pluggable key-value store with per-entry TTL for the SecurityHub Enabler.
+#   memory   - dict in the warm Lambda container (default)
+#   file     - JSON file, location is the file path (e.g. /tmp/sh_store.json)
+#   sqlite   - SQLite database, location is the file path (e.g. /tmp/sh_store.db)
+#   dynamodb - DynamoDB table, location is the table name; the table has a
+#              string partition key 'pk' and 'expires_at' as TTL attribute.
+#              DynamoDB Local can stand in through aws_endpoint_url.
+#
+# Environment Variables
+# store_backend (optional, memory | file | sqlite | dynamodb, default memory)
+# store_location (file path or table name, required for file, sqlite and dynamodb)
+#
+
+class MemoryStore:
+    def __init__(self, location=None):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or (entry[1] is not None and entry[1] < time.time()):
+            return None
+        return entry[0]
+
+    def put(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+class FileStore:
+    def __init__(self, location):
+        self.path = location
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, entries):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(entries, f)
+        os.replace(temp_path, self.path)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.load().get(key)
+        if entry is None or (entry['expires_at'] is not None and entry['expires_at'] < time.time()):
+            return None
+        return entry['value']
+
+    def put(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self.lock:
+            entries = self.load()
+            entries[key] = { 'value': value, 'expires_at': expires_at }
+            self.save(entries)
+
+    def delete(self, key):
+        with self.lock:
+            entries = self.load()
+            if entries.pop(key, None) is not None:
+                self.save(entries)
+
+class SQLiteStore:
+    def __init__(self, location):
+        # sqlite3 is only needed by this backend
+        import sqlite3
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(location, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS store (key TEXT PRIMARY KEY, value TEXT, expires_at REAL)')
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute('SELECT value, expires_at FROM store WHERE key = ?', (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None
+        return json.loads(row[0])
+
+    def put(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl is not None else None
+        # one transaction per write
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO store (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, json.dumps(value, default=str), expires_at))
+
+    def delete(self, key):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM store WHERE key = ?', (key,))
+
+class DynamoDBStore:
+    def __init__(self, location):
+        # boto3 is only needed by this backend
+        import boto3
+        self.table_name = location
+        self.client = get_client(boto3.Session(), 'dynamodb')
+
+    def get(self, key):
+        response = self.client.get_item(
+            TableName=self.table_name,
+            Key={ 'pk': { 'S': key } },
+            ConsistentRead=True
+        )
+        item = response.get('Item')
+        if item is None:
+            return None
+        # DynamoDB TTL deletion is lazy, check the expiry here too
+        if 'expires_at' in item and int(item['expires_at']['N']) < time.time():
+            return None
+        return json.loads(item['value']['S'])
+
+    def put(self, key, value, ttl=None):
+        item = {
+            'pk': { 'S': key },
+            'value': { 'S': json.dumps(value, default=str) }
+        }
+        if ttl is not None:
+            item['expires_at'] = { 'N': str(int(time.time() + ttl)) }
+        self.client.put_item(TableName=self.table_name, Item=item)
+
+    def delete(self, key):
+        self.client.delete_item(TableName=self.table_name, Key={ 'pk': { 'S': key } })
+
+BACKENDS = {
+    'memory': MemoryStore,
+    'file': FileStore,
+    'sqlite': SQLiteStore,
+    'dynamodb': DynamoDBStore
+}
+
+_lock = threading.Lock()
+_stores = {}
+
+def get_store(backend=None, location=None):
+    # one store per (backend, location) for the life of the container
+    backend = backend or os.environ.get('store_backend', 'memory')
+    location = location or os.environ.get('store_location')
+    with _lock:
+        store = _stores.get((backend, location))
+        if store is None:
+            store = BACKENDS[backend](location)
+            _stores[(backend, location)] = store
+    return store